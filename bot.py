@@ -1,25 +1,666 @@
 import telebot
 from telebot import types
-import pandas as pd
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
 from datetime import datetime, timedelta
-import schedule
 import time
 import threading
 import traceback
 import os
+import sys
+import bisect
+import io
+import csv
+import tempfile
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+import queue
+import asyncio
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import heapq
+import itertools
+import json
+import uuid
+import sqlite3
+import atexit
+import signal
+import hmac
+import secrets
+import hashlib
+import random
+from contextlib import contextmanager
+from collections import deque
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+try :
+    from openpyxl import Workbook
+except ImportError :
+    # Без openpyxl отчёты выгружаются в CSV
+    Workbook = None
 
 # Конфигурация бота
 TOKEN = ''
 MAIN_ADMIN_IDS = []
+INITIAL_CHANNEL_IDS = []  # каналы, которые добавляются в мониторинг при запуске
+
+# Настройки отчётов
+REPORT_FORMAT = 'xlsx'  # 'xlsx' или 'csv'
+REPORT_WORKERS = 2  # процессов для сборки отчётов
+REPORT_CACHE_SIZE = 8  # сколько готовых отчётов держать в кэше
+REPORT_CACHE_TTL = 24 * 60 * 60  # сколько секунд хранить готовый отчёт
+REPORT_DIR = 'bot_reports'  # каталог файлов отчётов, очищается при запуске и остановке
+
+# Настройки планировщика
+TIMER_MAX_SLEEP = 300  # максимальный сон планировщика, сек (защита от перевода часов)
+
+# Настройки хранилища
+STORAGE_BACKEND = 'sqlite'  # 'sqlite', 'journal' или 'memory'
+STORAGE_PATH = 'bot_data.sqlite3'
+JOURNAL_DIR = 'bot_journal'  # каталог журнала и снимков для STORAGE_BACKEND = 'journal'
+JOURNAL_SNAPSHOT_EVERY = 5000  # после скольких записей в журнал делать снимок
+JOURNAL_KEEP_SNAPSHOTS = 2  # сколько последних снимков хранить
+STORAGE_BATCH_SIZE = 200  # максимум операций в одной транзакции
+STORAGE_FLUSH_INTERVAL = 0.5  # сколько ждать накопления пакета записи, сек
+SESSION_TTL = 24 * 60 * 60  # через сколько секунд бездействия незаконченная анкета сбрасывается
+SESSION_SWEEP_INTERVAL = 10 * 60  # как часто удалять брошенные анкеты из памяти, сек
+PARSED_MESSAGES_CAPACITY = 10000  # сколько последних разосланных сообщений каналов и групп помнить
+ANNOUNCEMENT_DEDUP_WINDOW = 24 * 60 * 60  # в течение скольких секунд не рассылать повторно то же объявление из другого источника
+
+# Настройки рассылки
+BROADCAST_CONCURRENCY = 32  # одновременных отправок в одной рассылке
+PER_CHAT_INTERVAL = 1.0  # минимальный интервал между сообщениями в один чат, сек
+BROADCAST_PROGRESS_EVERY = 500  # как часто печатать прогресс рассылки
+BROADCAST_MAX_ATTEMPTS = 3  # попыток отправки одному получателю при сетевых ошибках и 5xx (кроме 429)
+BROADCAST_RETRY_DELAY = 1  # пауза перед повтором, сек; удваивается с каждой попыткой
+BROADCAST_STATE_DIR = 'broadcast_state'  # каталог с чекпоинтами рассылок
+BROADCAST_CHECKPOINT_INTERVAL = 5  # как часто сохранять прогресс рассылок, сек
+REMINDER_WINDOW = 30 * 60  # за сколько секунд равномерно разослать напоминание всем подписчикам
+REMINDER_BATCH_SIZE = 200  # получателей в одной пачке напоминаний
+REMINDER_JITTER = 0.5  # случайный сдвиг начала пачки, доля от интервала между пачками
+ALBUM_WAIT = 1.5  # сколько ждать следующую часть альбома из канала или группы, сек
+
+# Получение обновлений
+UPDATE_MODE = 'polling'  # 'polling' или 'webhook'
+WEBHOOK_URL = ''  # внешний адрес за reverse proxy, например https://example.com (пусто - не регистрировать webhook)
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_SECRET = ''  # значение заголовка X-Telegram-Bot-Api-Secret-Token (пусто - сгенерировать при регистрации webhook)
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8080
+UPDATE_LANES = 16  # полос (потоков) обработки обновлений; порядок сохраняется внутри чата
+LANE_QUEUE_SIZE = 1000  # обновлений в очереди одной полосы; при заполнении приём обновлений ждёт
+WEBHOOK_QUEUE_SIZE = 10000
+WEBHOOK_MAX_BODY = 1024 * 1024  # максимальный размер тела запроса webhook, байт
+METADATA_CACHE_SIZE = 1024  # сколько ответов get_chat / get_chat_member держать в кэше
+METADATA_CACHE_TTL = 10 * 60  # сколько секунд считать их актуальными
+TELEGRAM_API_URL = None  # адрес Bot API, например 'http://127.0.0.1:8081/bot{0}/{1}' для локального тестового сервера
+
+# Исходящие сообщения: общий лимит Telegram делится между классами по весам
+OUTBOUND_RATE = 30  # сообщений в секунду на всех получателей (лимит Telegram)
+OUTBOUND_WEIGHTS = {
+    'interactive': 8,  # ответы пользователям в диалоге
+    'admin': 4,  # уведомления администраторам
+    'broadcast': 2,  # рассылки и напоминания
+    'report': 1,  # отчёты
+}
+
+# HTTP-соединения с Bot API
+HTTP_POOL_SIZE = 32  # постоянных соединений; не меньше BROADCAST_CONCURRENCY
+HTTP_KEEPALIVE = 60  # сколько секунд держать простаивающее соединение открытым
+HTTP_CONNECT_TIMEOUT = 5  # сек
+HTTP_READ_TIMEOUT = 30  # сек
+HTTP_RETRIES = 3  # повторов синхронного запроса при ошибке соединения (запрос до Telegram не дошёл)
+
+if TELEGRAM_API_URL :
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+    asyncio_helper.API_URL = TELEGRAM_API_URL
+
+
+# Общий пул соединений для синхронных вызовов (обработчики, планировщик,
+# отчёты). Повторяются только ошибки соединения: повтор после отправки
+# запроса мог бы продублировать сообщение.
+def create_http_session() :
+    session = requests.Session()
+    retry = Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, status=0, backoff_factor=0.5)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+telebot.apihelper.session = create_http_session()
+telebot.apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+# Асинхронный контур: размер пула и таймаут сессии, которую создаёт telebot.
+asyncio_helper.REQUEST_LIMIT = HTTP_POOL_SIZE
+asyncio_helper.REQUEST_TIMEOUT = HTTP_READ_TIMEOUT
+# Повторы telebot срабатывают и по таймауту, когда запрос мог уже дойти до
+# Telegram, поэтому они выключены (рассылки повторяет BroadcastEngine)
+asyncio_helper.RETRY_ON_ERROR = False
+
+# Обработчики выполняются в потоках полос LaneDispatcher, а не в пуле telebot
+bot = telebot.TeleBot(TOKEN, threaded=False)
+# Асинхронный клиент для исходящих рассылок и уведомлений
+async_bot = AsyncTeleBot(TOKEN)
+
+
+# Диспетчер обновлений по "полосам": обновление попадает в полосу по chat.id,
+# каждая полоса обрабатывается своим потоком последовательно. Разные чаты
+# обрабатываются параллельно, а сообщения одного чата - строго по порядку
+# (на это рассчитаны шаги анкет и цепочки register_next_step_handler).
+class LaneDispatcher:
+    CHAT_UPDATES = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                    'my_chat_member', 'chat_member', 'chat_join_request')
+
+    def __init__(self, bot, lanes, queue_size):
+        self.bot = bot
+        # Исходная обработка telebot; bot.process_new_updates подменяется на submit
+        self.process = bot.process_new_updates
+        # Ограниченные очереди: переполненная полоса останавливает polling
+        # и очередь webhook (которая отвечает 503), а не копит обновления в памяти
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(lanes)]
+
+    def start(self):
+        for i, lane in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(lane,), name=f"lane-{i}")
+            thread.daemon = True
+            thread.start()
+
+    @classmethod
+    def chat_id(cls, update):
+        for name in cls.CHAT_UPDATES:
+            item = getattr(update, name, None)
+            if item is not None:
+                return item.chat.id
+        if update.callback_query is not None:
+            if update.callback_query.message is not None:
+                return update.callback_query.message.chat.id
+            return update.callback_query.from_user.id
+        return update.update_id
+
+    def submit(self, updates):
+        for update in updates:
+            # Блокирующая вставка: ждём, пока в полосе освободится место
+            self.queues[hash(self.chat_id(update)) % len(self.queues)].put(update)
+            # Сдвигаем offset после постановки в очередь, иначе polling получит эти обновления повторно
+            if update.update_id > self.bot.last_update_id:
+                self.bot.last_update_id = update.update_id
+
+    def _run(self, lane):
+        while True:
+            update = lane.get()
+            try:
+                self.process([update])
+            except Exception as e:
+                print(f"Ошибка при обработке обновления {update.update_id}: {str(e)}")
+                traceback.print_exc()
+            finally:
+                lane.task_done()
+
+
+update_lanes = LaneDispatcher(bot, UPDATE_LANES, LANE_QUEUE_SIZE)
+bot.process_new_updates = update_lanes.submit
+
+
+# Кэш метаданных Telegram (чаты, участники) с TTL и вытеснением давно не
+# использованных записей. Данные бота запрашиваются один раз при запуске,
+# записи чата сбрасываются по обновлениям my_chat_member.
+class TelegramCache:
+    def __init__(self, bot, max_entries, ttl):
+        self.bot = bot
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.me = None
+
+    def load_me(self):
+        self.me = self.bot.get_me()
+        return self.me
+
+    def get_me(self):
+        return self.me or self.load_me()
+
+    def get_chat(self, chat_id):
+        return self._get(('chat', chat_id), self.bot.get_chat, chat_id)
+
+    def get_chat_member(self, chat_id, user_id):
+        return self._get(('member', chat_id, user_id), self.bot.get_chat_member, chat_id, user_id)
+
+    def get_bot_member(self, chat_id):
+        return self.get_chat_member(chat_id, self.get_me().id)
+
+    def invalidate(self, chat_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == chat_id]:
+                del self.entries[key]
+
+    def _get(self, key, fetch, *args):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                return entry[1]
+        # Запрос выполняется без блокировки; ошибки не кэшируются
+        value = fetch(*args)
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+
+tg_cache = TelegramCache(bot, METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+
+# Права бота в чатах ведутся по обновлениям my_chat_member (storage.admin_chats).
+# Чат, о котором обновлений ещё не было (бот добавлен до появления индекса),
+# проверяется запросом один раз за запуск.
+probed_chats = set()
+
+
+def bot_is_admin(chat_id) :
+    if chat_id in storage.admin_chats :
+        return True
+    if chat_id in probed_chats :
+        return False
+    status = tg_cache.get_bot_member(chat_id).status
+    probed_chats.add(chat_id)
+    storage.set_admin_chat(chat_id, status in ['administrator', 'creator'])
+    return chat_id in storage.admin_chats
+
+
+def seed_admin_chats() :
+    # Сверка индекса при запуске: изменения за время простоя могли не дойти
+    for chat_id in storage.channels_to_monitor | storage.admin_chats :
+        try :
+            status = tg_cache.get_bot_member(chat_id).status
+        except Exception as e :
+            print(f"Не удалось проверить права бота в чате {chat_id}: {str(e)}")
+            continue
+        probed_chats.add(chat_id)
+        storage.set_admin_chat(chat_id, status in ['administrator', 'creator'])
+
+
+# Отложенная пакетная запись: обработчики кладут операции в очередь,
+# отдельный поток сбрасывает их в хранилище одной транзакцией
+class WriteBehindBatcher:
+    def __init__(self, apply_batch, batch_size, flush_interval):
+        self.apply_batch = apply_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ops = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="storage-writer")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, op):
+        self.ops.put(op)
+
+    def flush(self):
+        self.ops.join()
+
+    def _run(self):
+        while True:
+            batch = [self.ops.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.ops.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.apply_batch(batch)
+            except Exception as e:
+                print(f"Ошибка при записи в хранилище: {str(e)}")
+                traceback.print_exc()
+            finally:
+                for _ in batch:
+                    self.ops.task_done()
+
+
+# Хранилище без сохранения на диск (данные живут до перезапуска)
+class MemoryBackend:
+    def load(self):
+        return {}
+
+    def write(self, op, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+# Хранилище в SQLite (режим WAL) с отложенной пакетной записью
+class SQLiteBackend:
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS subscribers (chat_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS registrations (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS applications (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS admins (admin_id TEXT PRIMARY KEY, type TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS channels (chat_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS admin_chats (chat_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS parsed_messages (chat_id INTEGER, message_id INTEGER, PRIMARY KEY (chat_id, message_id));
+    '''
+
+    STATEMENTS = {
+        'subscribe': 'INSERT OR IGNORE INTO subscribers (chat_id) VALUES (?)',
+        'unsubscribe': 'DELETE FROM subscribers WHERE chat_id = ?',
+        'registration': 'INSERT INTO registrations (data) VALUES (?)',
+        'application': 'INSERT INTO applications (data) VALUES (?)',
+        'admin_add': 'INSERT OR REPLACE INTO admins (admin_id, type) VALUES (?, ?)',
+        'admin_remove': 'DELETE FROM admins WHERE admin_id = ?',
+        'channel_add': 'INSERT OR IGNORE INTO channels (chat_id) VALUES (?)',
+        'channel_remove': 'DELETE FROM channels WHERE chat_id = ?',
+        'setting': 'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+        'session_save': 'INSERT OR REPLACE INTO sessions (chat_id, data) VALUES (?, ?)',
+        'session_remove': 'DELETE FROM sessions WHERE chat_id = ?',
+        'admin_chat_add': 'INSERT OR IGNORE INTO admin_chats (chat_id) VALUES (?)',
+        'admin_chat_remove': 'DELETE FROM admin_chats WHERE chat_id = ?',
+        'parsed_add': 'INSERT OR IGNORE INTO parsed_messages (chat_id, message_id) VALUES (?, ?)',
+        'parsed_remove': 'DELETE FROM parsed_messages WHERE chat_id = ? AND message_id = ?',
+    }
+
+    def __init__(self, path, batch_size=STORAGE_BATCH_SIZE, flush_interval=STORAGE_FLUSH_INTERVAL):
+        # Соединение используется при загрузке и затем только потоком записи
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        self.batcher = WriteBehindBatcher(self._apply, batch_size, flush_interval)
+        self.batcher.start()
+
+    def load(self):
+        conn = self.conn
+        return {
+            'subscribers': [row[0] for row in conn.execute('SELECT chat_id FROM subscribers')],
+            'registrations': [json.loads(row[0]) for row in conn.execute('SELECT data FROM registrations ORDER BY id')],
+            'applications': [json.loads(row[0]) for row in conn.execute('SELECT data FROM applications ORDER BY id')],
+            'admins': dict(conn.execute('SELECT admin_id, type FROM admins')),
+            'channels': [row[0] for row in conn.execute('SELECT chat_id FROM channels')],
+            'settings': {key: json.loads(value) for key, value in conn.execute('SELECT key, value FROM settings')},
+            'sessions': {chat_id: json.loads(data) for chat_id, data in conn.execute('SELECT chat_id, data FROM sessions')},
+            'admin_chats': [row[0] for row in conn.execute('SELECT chat_id FROM admin_chats')],
+            'parsed_messages': list(conn.execute('SELECT chat_id, message_id FROM parsed_messages ORDER BY rowid')),
+        }
+
+    def write(self, op, *args):
+        self.batcher.put((op, args))
+
+    def _apply(self, batch):
+        with self.conn:
+            for op, args in batch:
+                if op in ('registration', 'application'):
+                    args = (json.dumps(args[0], ensure_ascii=False),)
+                elif op in ('setting', 'session_save'):
+                    args = (args[0], json.dumps(args[1], ensure_ascii=False))
+                self.conn.execute(self.STATEMENTS[op], args)
+
+    def close(self):
+        self.batcher.flush()
+        self.conn.close()
+
+
+# Хранилище "журнал + снимок": изменения дописываются в журнал, периодически
+# состояние сжимается в снимок. При запуске читается последний снимок и
+# проигрывается только хвост журнала. Своей копии данных журнал не держит:
+# снимок собирается из DataStorage через export (см. DataStorage.snapshot_state).
+class JournalBackend:
+    def __init__(self, directory, snapshot_every=JOURNAL_SNAPSHOT_EVERY,
+                 batch_size=STORAGE_BATCH_SIZE, flush_interval=STORAGE_FLUSH_INTERVAL):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.journal_path = os.path.join(directory, 'journal.log')
+        os.makedirs(directory, exist_ok=True)
+        self.export = None  # () -> (seq, состояние) для снимка
+        self.seq = 0  # номер последней операции, переданной в write
+        self.seq_lock = threading.Lock()
+        self.since_snapshot = 0
+        self.journal = None
+        self.batcher = WriteBehindBatcher(self._apply, batch_size, flush_interval)
+
+    @staticmethod
+    def empty_state():
+        return {
+            'subscribers': set(),
+            'registrations': [],
+            'applications': [],
+            'admins': {},
+            'channels': set(),
+            'settings': {},
+            'sessions': {},  # ключи - строки, как после загрузки снимка из JSON
+            'admin_chats': set(),
+            'parsed_messages': {},  # "chat_id:message_id" в порядке добавления
+        }
+
+    @staticmethod
+    def apply_op(state, op, args):
+        if op == 'subscribe':
+            state['subscribers'].add(args[0])
+        elif op == 'unsubscribe':
+            state['subscribers'].discard(args[0])
+        elif op == 'registration':
+            state['registrations'].append(args[0])
+        elif op == 'application':
+            state['applications'].append(args[0])
+        elif op == 'admin_add':
+            state['admins'][args[0]] = args[1]
+        elif op == 'admin_remove':
+            state['admins'].pop(args[0], None)
+        elif op == 'channel_add':
+            state['channels'].add(args[0])
+        elif op == 'channel_remove':
+            state['channels'].discard(args[0])
+        elif op == 'setting':
+            state['settings'][args[0]] = args[1]
+        elif op == 'session_save':
+            state['sessions'][str(args[0])] = args[1]
+        elif op == 'session_remove':
+            state['sessions'].pop(str(args[0]), None)
+        elif op == 'admin_chat_add':
+            state['admin_chats'].add(args[0])
+        elif op == 'admin_chat_remove':
+            state['admin_chats'].discard(args[0])
+        elif op == 'parsed_add':
+            state['parsed_messages'][f"{args[0]}:{args[1]}"] = True
+        elif op == 'parsed_remove':
+            state['parsed_messages'].pop(f"{args[0]}:{args[1]}", None)
+
+    def snapshots(self):
+        # Снимки от новых к старым
+        names = [name for name in os.listdir(self.directory)
+                 if name.startswith('snapshot-') and name.endswith('.json')]
+        return sorted(names, key=lambda name: int(name[len('snapshot-'):-len('.json')]), reverse=True)
+
+    def load(self):
+        # Состояние нужно только на время загрузки: дальше данные живут в DataStorage
+        state = self.empty_state()
+        snapshots = self.snapshots()
+        if snapshots:
+            with open(os.path.join(self.directory, snapshots[0]), 'r', encoding='utf-8') as file:
+                snapshot = json.load(file)
+            self.seq = snapshot['seq']
+            for key, value in snapshot['state'].items():
+                state[key] = set(value) if isinstance(state[key], set) else value
+
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Недописанная последняя строка после аварийного завершения
+                        break
+                    if entry['seq'] <= self.seq:
+                        continue
+                    self.apply_op(state, entry['op'], entry['args'])
+                    self.seq = entry['seq']
+                    replayed += 1
+        self.since_snapshot = replayed
+        print(f"Журнал: загружен снимок {snapshots[0] if snapshots else '-'}, проиграно записей: {replayed}")
+
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.batcher.start()
+        return {
+            'subscribers': list(state['subscribers']),
+            'registrations': state['registrations'],
+            'applications': state['applications'],
+            'admins': state['admins'],
+            'channels': list(state['channels']),
+            'settings': state['settings'],
+            'sessions': {int(chat_id): data for chat_id, data in state['sessions'].items()},
+            'admin_chats': list(state['admin_chats']),
+            'parsed_messages': [tuple(map(int, key.split(':'))) for key in state['parsed_messages']],
+        }
+
+    def write(self, op, *args):
+        # Номер операции присваивается сразу, чтобы снимок мог точно указать,
+        # какие операции в нём уже учтены
+        with self.seq_lock:
+            self.seq += 1
+            self.batcher.put((self.seq, op, args))
+
+    def _apply(self, batch):
+        lines = [json.dumps({'seq': seq, 'op': op, 'args': args}, ensure_ascii=False) + '\n'
+                 for seq, op, args in batch]
+        self.journal.writelines(lines)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.since_snapshot += len(batch)
+        if self.since_snapshot >= self.snapshot_every and self.export is not None:
+            self.snapshot()
+
+    def snapshot(self):
+        # Сохраняем текущее состояние DataStorage и начинаем журнал заново.
+        # Операции с номером до seq, ещё не записанные из очереди, попадут в
+        # новый журнал, но при загрузке будут пропущены как учтённые в снимке
+        seq, state = self.export()
+        path = os.path.join(self.directory, f"snapshot-{seq}.json")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'seq': seq, 'created': datetime.now().isoformat(), 'state': state}, file, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+        self.journal.close()
+        self.journal = open(self.journal_path, 'w', encoding='utf-8')
+        self.since_snapshot = 0
+        for name in self.snapshots()[JOURNAL_KEEP_SNAPSHOTS:]:
+            os.remove(os.path.join(self.directory, name))
+
+    def close(self):
+        self.batcher.flush()
+        if self.journal:
+            self.journal.close()
+
+
+def load_snapshot(directory=JOURNAL_DIR):
+    # Последний снимок журнала - вход для офлайн-отчётов
+    backend = JournalBackend(directory)
+    snapshots = backend.snapshots()
+    if not snapshots:
+        return None
+    with open(os.path.join(directory, snapshots[0]), 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def create_storage_backend():
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteBackend(STORAGE_PATH)
+    if STORAGE_BACKEND == 'journal':
+        return JournalBackend(JOURNAL_DIR)
+    return MemoryBackend()
+
+
+# Журнал регистраций, упорядоченный по времени: даты хранятся как datetime,
+# выборка за период - бинарный поиск и срез
+class RegistrationLog:
+    DATE_FORMAT = '%Y-%m-%d %H:%M'
+
+    def __init__(self):
+        self.rows = []
+        self.times = []
 
-bot = telebot.TeleBot(TOKEN)
+    def __len__(self):
+        return len(self.rows)
 
+    def __iter__(self):
+        return iter(self.rows)
 
-# Хранилища данных в памяти
+    def append(self, row, registered_at=None):
+        if registered_at is None:
+            registered_at = datetime.strptime(row['Дата регистрации'], self.DATE_FORMAT)
+        if not self.times or registered_at >= self.times[-1]:
+            self.rows.append(row)
+            self.times.append(registered_at)
+        else:
+            index = bisect.bisect_right(self.times, registered_at)
+            self.rows.insert(index, row)
+            self.times.insert(index, registered_at)
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def window(self, start, end=None):
+        # Регистрации в интервале [start, end): строки и их даты
+        lo = bisect.bisect_left(self.times, start)
+        hi = bisect.bisect_left(self.times, end) if end is not None else len(self.times)
+        return self.rows[lo:hi], self.times[lo:hi]
+
+
+# Последние обработанные сообщения каналов и групп: ключ (chat_id, message_id),
+# при переполнении вытесняются самые старые
+class ParsedMessages:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, key):
+        # Возвращает (добавлен ли ключ, вытесненные ключи)
+        with self.lock:
+            if key in self.keys:
+                return False, []
+            self.keys[key] = None
+            evicted = []
+            while len(self.keys) > self.capacity:
+                evicted.append(self.keys.popitem(last=False)[0])
+            return True, evicted
+
+
+# Хранилища данных: рабочие данные в памяти, изменения пишутся в backend
 class DataStorage:
+    # Настройки, которые сохраняются в хранилище
+    SETTINGS = ('mailing_settings', 'reminder_text', 'reminder_frequency', 'last_reminder_sent', 'timers')
+
     def __init__(self):
+        self.backend = MemoryBackend()
         self.user_data = {}
-        self.event_registrations = []
+        self.event_registrations = RegistrationLog()
         self.vacancy_applications = []
         self.admins = {admin_id: 'main' for admin_id in MAIN_ADMIN_IDS}
         self.mailing_settings = {
@@ -28,17 +669,181 @@ class DataStorage:
             'time': '12:00'
         }
         self.subscribed_users = set()
-        self.parsed_messages = set()
+        self.parsed_messages = ParsedMessages(PARSED_MESSAGES_CAPACITY)
         self.channels_to_monitor = set()
+        self.admin_chats = set()  # чаты и каналы, где бот - администратор
         # Добавляем новые поля для напоминаний
         self.reminder_text = None
         self.reminder_frequency = 1  # 1 - раз в неделю, 2 - раз в 2 недели, 3 - раз в 3 недели
         self.last_reminder_sent = None
+        self.timers = {}  # сохранённые таймеры планировщика
+        # Добавление в списки и запись операции - под одной блокировкой, чтобы
+        # снимок журнала не учёл одну и ту же регистрацию дважды
+        self.lock = threading.Lock()
+
+    def attach(self, backend):
+        # Подключаем хранилище и загружаем из него сохранённое состояние
+        self.backend = backend
+        state = backend.load()
+        if isinstance(backend, JournalBackend):
+            backend.export = self.snapshot_state
+        self.subscribed_users.update(state.get('subscribers', []))
+        self.event_registrations.extend(state.get('registrations', []))
+        self.vacancy_applications.extend(state.get('applications', []))
+        for admin_id, admin_type in state.get('admins', {}).items():
+            self.admins.setdefault(admin_id, admin_type)
+        self.channels_to_monitor.update(state.get('channels', []))
+        self.admin_chats.update(state.get('admin_chats', []))
+        for chat_id, message_id in state.get('parsed_messages', []):
+            for evicted in self.parsed_messages.add((chat_id, message_id))[1]:
+                self.backend.write('parsed_remove', *evicted)
+        for name, value in state.get('settings', {}).items():
+            if name not in self.SETTINGS:
+                continue
+            if name == 'last_reminder_sent' and value:
+                value = datetime.fromisoformat(value)
+            setattr(self, name, value)
+        # Незаконченные анкеты переживают перезапуск; устаревшие удаляем
+        now = time.time()
+        for chat_id, data in state.get('sessions', {}).items():
+            user = UserData.from_dict(data)
+            if now - user.updated_at > SESSION_TTL:
+                self.backend.write('session_remove', chat_id)
+            else:
+                self.user_data[chat_id] = user
+
+    def snapshot_state(self):
+        # Состояние для снимка журнала в его формате и номер последней учтённой
+        # операции. Копируются только ссылки на строки, не сами данные
+        with self.lock:
+            seq = self.backend.seq
+            registrations = list(self.event_registrations)
+            applications = list(self.vacancy_applications)
+        settings = {}
+        for name in self.SETTINGS:
+            value = getattr(self, name)
+            settings[name] = value.isoformat() if isinstance(value, datetime) else value
+        return seq, {
+            'subscribers': list(self.subscribed_users),
+            'registrations': registrations,
+            'applications': applications,
+            'admins': {admin_id: admin_type for admin_id, admin_type in list(self.admins.items())
+                       if not (admin_id in MAIN_ADMIN_IDS and admin_type == 'main')},
+            'channels': list(self.channels_to_monitor),
+            'settings': settings,
+            'sessions': {str(chat_id): user.to_dict() for chat_id, user in list(self.user_data.items())
+                         if user.step is not None},
+            'admin_chats': list(self.admin_chats),
+            'parsed_messages': {f"{chat_id}:{message_id}": True for chat_id, message_id in list(self.parsed_messages.keys)},
+        }
+
+    def close(self):
+        self.backend.close()
+
+    def subscribe(self, chat_id):
+        if chat_id not in self.subscribed_users:
+            self.subscribed_users.add(chat_id)
+            self.backend.write('subscribe', chat_id)
+
+    def unsubscribe(self, chat_id):
+        if chat_id in self.subscribed_users:
+            self.subscribed_users.discard(chat_id)
+            self.backend.write('unsubscribe', chat_id)
+
+    def add_registration(self, registration_data, registered_at=None):
+        with self.lock:
+            self.event_registrations.append(registration_data, registered_at)
+            self.backend.write('registration', registration_data)
+
+    def add_application(self, application_data):
+        with self.lock:
+            self.vacancy_applications.append(application_data)
+            self.backend.write('application', application_data)
+
+    def add_admin(self, admin_id, admin_type='regular'):
+        self.admins[admin_id] = admin_type
+        self.backend.write('admin_add', admin_id, admin_type)
+
+    def remove_admin(self, admin_id):
+        if self.admins.pop(admin_id, None) is not None:
+            self.backend.write('admin_remove', admin_id)
+
+    def add_channel(self, channel_id):
+        if channel_id not in self.channels_to_monitor:
+            self.channels_to_monitor.add(channel_id)
+            self.backend.write('channel_add', channel_id)
+
+    def remove_channel(self, channel_id):
+        if channel_id in self.channels_to_monitor:
+            self.channels_to_monitor.discard(channel_id)
+            self.backend.write('channel_remove', channel_id)
+
+    def get_session(self, chat_id):
+        # Анкета чата; брошенная дольше SESSION_TTL считается истёкшей
+        user = self.user_data.get(chat_id)
+        if user is not None and time.time() - user.updated_at > SESSION_TTL:
+            self.end_session(chat_id)
+            return None
+        return user
+
+    def set_step(self, chat_id, step):
+        # Переход анкеты в новое состояние и сохранение её целиком
+        user = self.user_data[chat_id]
+        user.step = step
+        user.updated_at = time.time()
+        self.backend.write('session_save', chat_id, user.to_dict())
+
+    def end_session(self, chat_id):
+        if self.user_data.pop(chat_id, None) is not None:
+            self.backend.write('session_remove', chat_id)
+
+    def expire_sessions(self):
+        # Удаляем анкеты, брошенные дольше SESSION_TTL; возвращаем их число
+        deadline = time.time() - SESSION_TTL
+        expired = [chat_id for chat_id, user in list(self.user_data.items()) if user.updated_at < deadline]
+        for chat_id in expired:
+            self.end_session(chat_id)
+        return len(expired)
+
+    def active_sessions(self):
+        return len(self.user_data)
+
+    def mark_parsed(self, chat_id, message_id):
+        # True, если сообщение встретилось впервые
+        added, evicted = self.parsed_messages.add((chat_id, message_id))
+        if added:
+            self.backend.write('parsed_add', chat_id, message_id)
+            for key in evicted:
+                self.backend.write('parsed_remove', *key)
+        return added
+
+    def set_admin_chat(self, chat_id, is_admin):
+        if is_admin and chat_id not in self.admin_chats:
+            self.admin_chats.add(chat_id)
+            self.backend.write('admin_chat_add', chat_id)
+        elif not is_admin and chat_id in self.admin_chats:
+            self.admin_chats.discard(chat_id)
+            self.backend.write('admin_chat_remove', chat_id)
+
+    def set_setting(self, name, value):
+        setattr(self, name, value)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        self.backend.write('setting', name, value)
+
+    def update_mailing_settings(self, **changes):
+        self.set_setting('mailing_settings', {**self.mailing_settings, **changes})
 
 storage = DataStorage()
 
 
 class UserData:
+    # Поля анкеты, которые сохраняются в хранилище
+    FIELDS = ('name', 'phone', 'event_or_vacancy', 'needs_pass', 'about', 'cv_file_id',
+              'option', 'step', 'reviewing', 'username', 'updated_at')
+    # Без __dict__: анкет в памяти может быть много
+    __slots__ = FIELDS
+
     def __init__(self):
         self.name = None
         self.phone = None
@@ -50,6 +855,18 @@ class UserData:
         self.step = None
         self.reviewing = False
         self.username = None  # Добавляем поле для username
+        self.updated_at = time.time()  # время последнего шага анкеты
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+
+    @classmethod
+    def from_dict(cls, data):
+        user = cls()
+        for field in cls.FIELDS:
+            if field in data:
+                setattr(user, field, data[field])
+        return user
 
     def get_summary(self):
         if self.option == 'event':
@@ -81,13 +898,912 @@ def is_main_admin(user_id):
     return str(user_id) in MAIN_ADMIN_IDS
 
 
-def schedule_mailing() :
-    schedule.clear()
-    if storage.mailing_settings['enabled'] :
-        days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
-        day_name = days[storage.mailing_settings['day_of_week']]
-        getattr(schedule.every(), day_name).at(storage.mailing_settings['time']).do(send_weekly_report)
-        print(f"Рассылка запланирована на каждый {day_name} в {storage.mailing_settings['time']}")
+# Маршрутизация кнопок меню: обработчик ищется в словаре по паре
+# (текст кнопки, роль отправителя) вместо перебора фильтров
+class TextRouter:
+    def __init__(self):
+        self.routes = {}
+        self.labels = set()
+
+    def route(self, texts, *roles):
+        def decorator(handler):
+            for text in texts:
+                self.labels.add(text)
+                for role in roles:
+                    # При совпадении текста выигрывает обработчик, объявленный раньше
+                    self.routes.setdefault((text, role), handler)
+            return handler
+        return decorator
+
+    @staticmethod
+    def role(chat_id):
+        if is_main_admin(chat_id):
+            return 'main'
+        if is_admin(chat_id):
+            return 'admin'
+        return 'user'
+
+    def lookup(self, message):
+        if message.text is None:
+            return None
+        return self.routes.get((message.text, self.role(message.chat.id)))
+
+
+text_router = TextRouter()
+
+
+# Ограничитель скорости "ведро токенов"
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # Забирает токен и возвращает, сколько секунд нужно подождать перед отправкой
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+# Ограничитель частоты сообщений в один чат
+class ChatRateLimiter:
+    def __init__(self, interval, max_chats=100000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self.next_allowed = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, chat_id):
+        with self.lock:
+            now = time.monotonic()
+            if len(self.next_allowed) > self.max_chats:
+                self.next_allowed = {k: v for k, v in self.next_allowed.items() if v > now}
+            slot = max(now, self.next_allowed.get(chat_id, 0))
+            self.next_allowed[chat_id] = slot + self.interval
+            return slot - now
+
+
+# Очередь исходящих сообщений с приоритетами: каждое сообщение ждёт токен
+# общего лимита OUTBOUND_RATE, токены раздаются классам пропорционально весам
+# (stride scheduling). Рассылка на тысячи получателей не вытесняет ответы в
+# диалоге, но и сама не останавливается полностью.
+class OutboundGate:
+    # Методы, на которые распространяется лимит
+    GATED_PREFIXES = ('send', 'copy', 'forward')
+
+    def __init__(self, rate, weights):
+        self.bucket = TokenBucket(rate)
+        self.weights = weights
+        self.queues = {name: deque() for name in weights}
+        self.passes = {name: 0.0 for name in weights}
+        self.cond = threading.Condition()
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="outbound-gate")
+        thread.daemon = True
+        thread.start()
+
+    def depths(self):
+        with self.cond:
+            return {name: len(pending) for name, pending in self.queues.items()}
+
+    def acquire(self, priority):
+        granted = threading.Event()
+        self._put(priority, granted.set)
+        granted.wait()
+
+    async def acquire_async(self, priority):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant():
+            # Ожидание могли отменить (например, при остановке рассылок)
+            if not granted.done():
+                granted.set_result(None)
+
+        self._put(priority, lambda: loop.call_soon_threadsafe(grant))
+        await granted
+
+    def _put(self, priority, grant):
+        with self.cond:
+            pending = self.queues[priority]
+            if not pending:
+                # Простаивавший класс не копит запас: догоняет текущих
+                active = [self.passes[name] for name, other in self.queues.items() if other]
+                if active:
+                    self.passes[priority] = max(self.passes[priority], min(active))
+            pending.append(grant)
+            self.cond.notify()
+
+    def _next(self):
+        with self.cond:
+            while not any(self.queues.values()):
+                self.cond.wait()
+            name = min((name for name, pending in self.queues.items() if pending), key=self.passes.get)
+            self.passes[name] += 1 / self.weights[name]
+            return self.queues[name].popleft()
+
+    def _run(self):
+        while True:
+            grant = self._next()
+            delay = self.bucket.reserve()
+            if delay > 0:
+                time.sleep(delay)
+            grant()
+
+
+outbound = OutboundGate(OUTBOUND_RATE, OUTBOUND_WEIGHTS)
+
+
+# Класс исходящих сообщений текущего потока; по умолчанию - ответ в диалоге
+class OutboundContext(threading.local):
+    priority = 'interactive'
+
+
+outbound_context = OutboundContext()
+
+
+@contextmanager
+def outbound_priority(priority):
+    previous = outbound_context.priority
+    outbound_context.priority = priority
+    try:
+        yield
+    finally:
+        outbound_context.priority = previous
+
+
+def send_request(method, url, **kwargs):
+    # Все синхронные запросы telebot проходят здесь (apihelper.CUSTOM_REQUEST_SENDER)
+    if url.rsplit('/', 1)[-1].startswith(OutboundGate.GATED_PREFIXES):
+        outbound.acquire(outbound_context.priority)
+    return telebot.apihelper.session.request(method, url, **kwargs)
+
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = send_request
+
+
+# Методы, доступные рассылкам: метод Bot API и имена позиционных аргументов
+BROADCAST_METHODS = {
+    'send_message': ('sendMessage', ('text',)),
+    'send_photo': ('sendPhoto', ('photo',)),
+    'send_document': ('sendDocument', ('document',)),
+    'send_video': ('sendVideo', ('video',)),
+    'copy_message': ('copyMessage', ('from_chat_id', 'message_id')),
+    'send_media_group': ('sendMediaGroup', ('media',)),
+}
+
+
+def render_payload(method, *args, **kwargs):
+    # Параметры запроса Bot API без chat_id, уже приведённые к строкам
+    api_method, names = BROADCAST_METHODS[method]
+    params = {}
+    for name, value in list(zip(names, args)) + list(kwargs.items()):
+        if value is None:
+            continue
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False)
+        elif hasattr(value, 'to_json'):
+            value = value.to_json()
+        params[name] = str(value)
+    return {'api_method': api_method, 'params': params}
+
+
+class BroadcastJob:
+    def __init__(self, job_id, title, payload, recipients, states=None, attempts=None, spread=None):
+        self.id = job_id
+        self.title = title
+        # spread - растянуть рассылку: {'start': время постановки, 'window': сек, 'batch': размер пачки}
+        self.spread = spread
+        # payload - метод Bot API и параметры без chat_id; тело запроса
+        # кодируется один раз, для каждого получателя дописывается только chat_id
+        self.payload = payload
+        self.body = urllib.parse.urlencode(payload['params']).encode()
+        self.recipients = list(recipients)
+        self.states = states if states is not None else {user_id: 'pending' for user_id in self.recipients}
+        self.attempts = attempts if attempts is not None else {}
+        self.total = len(self.recipients)
+        self.sent = sum(1 for state in self.states.values() if state == 'sent')
+        self.failed = sum(1 for state in self.states.values() if state in ('failed', 'blocked'))
+        self.started = None
+        self.finished = None
+        self.dirty = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def pending(self):
+        return [user_id for user_id in self.recipients if self.states.get(user_id) == 'pending']
+
+    def record(self, user_id, state):
+        with self.lock:
+            self.states[user_id] = state
+            if state == 'sent':
+                self.sent += 1
+            else:
+                self.failed += 1
+            self.dirty += 1
+            processed = self.sent + self.failed
+            if processed == self.total:
+                self.finished = time.monotonic()
+        return processed
+
+    def report(self):
+        elapsed = max((self.finished or time.monotonic()) - self.started, 0.001)
+        return (f"Рассылка '{self.title}': отправлено {self.sent} из {self.total}, "
+                f"ошибок {self.failed}, за {elapsed:.1f} с ({self.sent / elapsed:.1f} сообщ./с)")
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'id': self.id,
+                'title': self.title,
+                'payload': self.payload,
+                'spread': self.spread,
+                'recipients': self.recipients,
+                'states': [[user_id, state] for user_id, state in self.states.items()],
+                'attempts': [[user_id, count] for user_id, count in self.attempts.items()],
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['id'], data['title'], data['payload'], data['recipients'],
+            states={user_id: state for user_id, state in data['states']},
+            attempts={user_id: count for user_id, count in data['attempts']},
+            spread=data.get('spread'),
+        )
+
+
+# Асинхронный контур для исходящих запросов: отдельный поток с циклом asyncio
+# и AsyncTeleBot. Рассылки и уведомления админам выполняются здесь и не
+# занимают потоки обработчиков.
+class AsyncRuntime:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="asyncio-runtime")
+        self.thread.daemon = True
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        if not self.thread.is_alive():
+            self.thread.start()
+            self.submit(self._open_session()).result(5)
+
+    async def _open_session(self):
+        # Сессия aiohttp с постоянными соединениями; telebot использует её,
+        # пока она открыта (session_manager привязан к потоку цикла)
+        manager = asyncio_helper.session_manager
+        manager.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ssl=manager.ssl_context,
+        ))
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        # Закрываем HTTP-сессию aiohttp (она создаётся в потоке цикла)
+        async def close_session():
+            session = asyncio_helper.session_manager.session
+            if session and not session.closed:
+                await session.close()
+
+        if self.thread.is_alive():
+            self.submit(close_session()).result(5)
+
+
+runtime = AsyncRuntime()
+
+
+# Движок рассылок: каждая рассылка - корутина, которая рассылает сообщения
+# через asyncio.gather с ограничением BROADCAST_CONCURRENCY, с общим лимитом
+# скорости и лимитом на чат. Состояние каждой рассылки сохраняется в
+# BROADCAST_STATE_DIR, чтобы после перезапуска продолжить с места остановки.
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+class BroadcastEngine:
+    def __init__(self, concurrency, per_chat_interval, state_dir):
+        self.concurrency = concurrency
+        self.state_dir = state_dir
+        self.chat_limiter = ChatRateLimiter(per_chat_interval)
+        self.paused_until = 0
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.tasks = {}  # задачи цикла: рассылки по id и сохранение прогресса
+        self.stopped = False
+
+    def start(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        runtime.start()
+        runtime.submit(self._checkpoint_loop())
+
+    def stop(self):
+        # Останавливаем рассылки и сохраняем их прогресс, пока цикл ещё работает;
+        # после перезапуска они продолжатся с того же места
+        self.stopped = True
+        if runtime.thread.is_alive():
+            try:
+                runtime.submit(self._halt()).result(5)
+            except Exception as e:
+                print(f"Ошибка при остановке рассылок: {str(e)}")
+        with self.jobs_lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            try:
+                if not job.done.is_set():
+                    self._checkpoint(job)
+            except Exception as e:
+                print(f"Ошибка при сохранении состояния рассылки {job.id}: {str(e)}")
+
+    async def _halt(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, title, recipients, method, *args, spread=None, **kwargs):
+        # spread=(окно, размер пачки) - отправлять пачками, распределённо по окну
+        job_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        if spread:
+            spread = {'start': time.time(), 'window': spread[0], 'batch': spread[1]}
+        job = BroadcastJob(job_id, title, render_payload(method, *args, **kwargs), recipients, spread=spread)
+        if not job.recipients:
+            job.done.set()
+            return job
+        self._checkpoint(job)
+        print(f"Рассылка '{title}' поставлена в очередь: {job.total} получателей")
+        self._enqueue(job)
+        return job
+
+    def resume(self):
+        # Возобновляем рассылки, прерванные перезапуском бота
+        if not os.path.isdir(self.state_dir):
+            return
+        for filename in sorted(os.listdir(self.state_dir)):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.state_dir, filename)
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    job = BroadcastJob.from_dict(json.load(file))
+            except Exception as e:
+                print(f"Не удалось загрузить состояние рассылки {filename}: {str(e)}")
+                continue
+            pending = job.pending()
+            if not pending:
+                os.remove(path)
+                continue
+            print(f"Возобновляем рассылку '{job.title}': осталось {len(pending)} из {job.total}")
+            self._enqueue(job)
+
+    def _enqueue(self, job):
+        job.started = time.monotonic()
+        with self.jobs_lock:
+            self.jobs[job.id] = job
+        if not self.stopped:
+            runtime.submit(self._run_job(job))
+
+    def _checkpoint(self, job):
+        path = os.path.join(self.state_dir, f"{job.id}.json")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(job.to_dict(), file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        job.dirty = 0
+
+    def _finish(self, job):
+        print(job.report())
+        with self.jobs_lock:
+            self.jobs.pop(job.id, None)
+        try:
+            os.remove(os.path.join(self.state_dir, f"{job.id}.json"))
+        except FileNotFoundError:
+            pass
+        job.done.set()
+
+    async def _checkpoint_loop(self):
+        self.tasks['checkpoint'] = asyncio.current_task()
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            with self.jobs_lock:
+                jobs = list(self.jobs.values())
+            for job in jobs:
+                try:
+                    if job.dirty and not job.done.is_set():
+                        await asyncio.to_thread(self._checkpoint, job)
+                except Exception as e:
+                    print(f"Ошибка при сохранении состояния рассылки {job.id}: {str(e)}")
+
+    def _plan(self, job):
+        # Пачки получателей и время (time.time()) начала каждой
+        pending = job.pending()
+        if not job.spread or not pending:
+            return [(0, pending)]
+        size = job.spread['batch']
+        batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+        # После перезапуска оставшиеся пачки распределяются по остатку окна
+        now = time.time()
+        slot = max(job.spread['start'] + job.spread['window'] - now, 0) / len(batches)
+        return [(now + i * slot + random.uniform(0, slot * REMINDER_JITTER), batch)
+                for i, batch in enumerate(batches)]
+
+    async def _run_batch(self, job, batch):
+        pending = iter(batch)
+
+        async def worker():
+            # Общий итератор: одновременно обрабатывается не больше concurrency получателей
+            for user_id in pending:
+                state = await self._deliver(job, user_id)
+                processed = job.record(user_id, state)
+                if processed % BROADCAST_PROGRESS_EVERY == 0 and processed != job.total:
+                    print(f"Рассылка '{job.title}': обработано {processed} из {job.total}")
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    async def _run_job(self, job):
+        self.tasks[job.id] = asyncio.current_task()
+        try:
+            for start_at, batch in self._plan(job):
+                delay = start_at - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._run_batch(job, batch)
+        except Exception as e:
+            print(f"Ошибка в рассылке '{job.title}': {str(e)}")
+            traceback.print_exc()
+            return
+        finally:
+            self.tasks.pop(job.id, None)
+        self._finish(job)
+
+    async def _wait_turn(self, user_id):
+        delay = max(self.paused_until - time.monotonic(), self.chat_limiter.reserve(user_id))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await outbound.acquire_async('broadcast')
+
+    async def _send(self, job, user_id):
+        # Запрос собирается из готового тела; ответ не разбирается в объекты telebot
+        api_method = job.payload['api_method']
+        session = await asyncio_helper.session_manager.get_session()
+        async with session.post(
+            asyncio_helper.API_URL.format(TOKEN, api_method),
+            data=job.body + b'&chat_id=' + str(user_id).encode(),
+            headers=FORM_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            proxy=asyncio_helper.proxy,
+        ) as response:
+            await asyncio_helper._check_result(api_method, response)
+
+    async def _deliver(self, job, user_id):
+        while True:
+            await self._wait_turn(user_id)
+            try:
+                await self._send(job, user_id)
+                return 'sent'
+            except asyncio_helper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    # Flood wait: ждём столько, сколько сказал Telegram, и пробуем снова
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 5)
+                    print(f"Превышен лимит Telegram, пауза рассылки на {retry_after} с")
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                    continue
+                if e.error_code == 403:
+                    # Пользователь заблокировал бота или удалил аккаунт
+                    print(f"Пользователь {user_id} недоступен, отписываем: {e.description}")
+                    storage.unsubscribe(user_id)
+                    return 'blocked'
+                if 400 <= e.error_code < 500:
+                    # Чат не найден, неверный запрос и т.п. - повтор не поможет
+                    print(f"Ошибка при отправке сообщения пользователю {user_id}: {str(e)}")
+                    return 'failed'
+                error = e
+            except Exception as e:
+                error = e
+            with job.lock:
+                attempts = job.attempts.get(user_id, 0) + 1
+                job.attempts[user_id] = attempts
+            if attempts >= BROADCAST_MAX_ATTEMPTS:
+                print(f"Ошибка при отправке сообщения пользователю {user_id}: {str(error)}")
+                return 'failed'
+            # Сетевая ошибка или 5xx: повторяем с растущей паузой
+            await asyncio.sleep(BROADCAST_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+broadcaster = BroadcastEngine(BROADCAST_CONCURRENCY, PER_CHAT_INTERVAL, BROADCAST_STATE_DIR)
+
+
+async def notify_admins(text, document=None):
+    # Уведомления всем админам параллельно; медленный админ не задерживает остальных
+    async def notify(admin_id):
+        try:
+            await outbound.acquire_async('admin')
+            await async_bot.send_message(admin_id, text)
+            if document:
+                await outbound.acquire_async('admin')
+                await async_bot.send_document(admin_id, document)
+        except Exception as e:
+            print(f"Ошибка при отправке уведомления админу {admin_id}: {str(e)}")
+
+    await asyncio.gather(*(notify(admin_id) for admin_id in list(storage.admins.keys())))
+
+
+# Пул процессов для сборки отчётов (spawn - дочерние процессы не наследуют потоки бота)
+def create_report_pool() :
+    return ProcessPoolExecutor(max_workers=REPORT_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+report_pool = create_report_pool()
+report_pool_lock = threading.Lock()
+
+
+def submit_to_report_pool(fn, *args) :
+    # Упавший дочерний процесс ломает весь пул - пересоздаём его
+    global report_pool
+    with report_pool_lock :
+        try :
+            return report_pool.submit(fn, *args)
+        except BrokenProcessPool :
+            print("Пул сборки отчётов сломан, создаём заново")
+            report_pool.shutdown(wait=False)
+            report_pool = create_report_pool()
+            return report_pool.submit(fn, *args)
+
+
+# Планировщик на куче таймеров: поток спит до ближайшего срока, а не
+# просыпается каждую секунду. Таймер задаётся именем задачи из TIMER_TASKS,
+# поэтому список таймеров сохраняется в хранилище и переживает перезапуск.
+class TimerScheduler:
+    def __init__(self):
+        self.heap = []
+        self.timers = {}
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def schedule(self, name, when, task, *args):
+        # Повторный вызов с тем же именем переносит таймер на новое время
+        with self.cond:
+            seq = next(self.counter)
+            self.timers[name] = {'when': when, 'task': task, 'args': list(args), 'seq': seq}
+            heapq.heappush(self.heap, (when, seq, name))
+            self._persist()
+            self.cond.notify()
+
+    def cancel(self, name):
+        with self.cond:
+            if self.timers.pop(name, None) is not None:
+                self._persist()
+                self.cond.notify()
+
+    def get(self, name):
+        with self.cond:
+            timer = self.timers.get(name)
+            return timer['when'] if timer else None
+
+    def restore(self, saved):
+        for name, timer in saved.items():
+            if timer['task'] not in TIMER_TASKS:
+                continue
+            self.schedule(name, datetime.fromisoformat(timer['when']), timer['task'], *timer['args'])
+
+    def _persist(self):
+        storage.set_setting('timers', {
+            name: {'when': timer['when'].isoformat(), 'task': timer['task'], 'args': timer['args']}
+            for name, timer in self.timers.items()
+        })
+
+    def _next_due(self):
+        with self.cond:
+            while True:
+                # Пропускаем отменённые и перенесённые записи кучи
+                while self.heap:
+                    when, seq, name = self.heap[0]
+                    timer = self.timers.get(name)
+                    if timer is not None and timer['seq'] == seq:
+                        break
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                delay = (self.heap[0][0] - datetime.now()).total_seconds()
+                if delay > 0:
+                    # Ограничиваем сон на случай перевода системных часов
+                    self.cond.wait(min(delay, TIMER_MAX_SLEEP))
+                    continue
+                when, seq, name = heapq.heappop(self.heap)
+                timer = self.timers.pop(name)
+                self._persist()
+                return name, timer
+
+    def run(self):
+        while True:
+            name, timer = self._next_due()
+            try:
+                TIMER_TASKS[timer['task']](*timer['args'])
+            except Exception as e:
+                print(f"Ошибка в задаче планировщика {name}: {str(e)}")
+                traceback.print_exc()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="scheduler")
+        thread.daemon = True
+        thread.start()
+
+
+scheduler = TimerScheduler()
+
+
+def next_weekly_run(now=None) :
+    now = now or datetime.now()
+    hour, minute = map(int, storage.mailing_settings['time'].split(':'))
+    run_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    run_at += timedelta(days=(storage.mailing_settings['day_of_week'] - now.weekday()) % 7)
+    if run_at <= now :
+        run_at += timedelta(days=7)
+    return run_at
+
+
+def schedule_mailing(keep_existing=False) :
+    # keep_existing - при запуске не сдвигать таймер, восстановленный из хранилища
+    if not storage.mailing_settings['enabled'] :
+        scheduler.cancel('weekly_report')
+        return
+    if keep_existing and scheduler.get('weekly_report') :
+        return
+    run_at = next_weekly_run()
+    scheduler.schedule('weekly_report', run_at, 'weekly_report')
+    print(f"Рассылка запланирована на {run_at.strftime('%Y-%m-%d %H:%M')}")
+
+
+def schedule_reminders(keep_existing=False) :
+    if not storage.reminder_text :
+        scheduler.cancel('reminder')
+        return
+    if keep_existing and scheduler.get('reminder') :
+        return
+    if storage.last_reminder_sent :
+        run_at = storage.last_reminder_sent + timedelta(weeks=storage.reminder_frequency)
+    else :
+        run_at = datetime.now()
+    scheduler.schedule('reminder', run_at, 'reminder')
+
+
+def schedule_post(when, text) :
+    # Отложенная публикация для всех подписчиков
+    scheduler.schedule(f"post_{uuid.uuid4().hex[:8]}", when, 'post', text)
+
+
+def send_scheduled_post(text) :
+    broadcaster.submit("запланированный пост", list(storage.subscribed_users), 'send_message', text)
+
+
+def run_weekly_report() :
+    try :
+        send_weekly_report()
+    finally :
+        schedule_mailing()
+
+
+def schedule_session_sweep(keep_existing=False) :
+    if keep_existing and scheduler.get('session_sweep') :
+        return
+    scheduler.schedule('session_sweep', datetime.now() + timedelta(seconds=SESSION_SWEEP_INTERVAL), 'session_sweep')
+
+
+def sweep_sessions() :
+    try :
+        expired = storage.expire_sessions()
+        if expired :
+            print(f"Удалено брошенных анкет: {expired}")
+    finally :
+        schedule_session_sweep()
+
+
+# Потоковая выгрузка отчётов: строки пишутся сразу в файл, без DataFrame и
+# без сборки всего отчёта в памяти
+def write_report(rows, buffer, fmt=REPORT_FORMAT, header=True):
+    rows = iter(rows)
+    first = next(rows, None)
+    columns = list(first.keys()) if first else []
+
+    if fmt == 'xlsx' and Workbook is not None:
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(columns)
+        if first:
+            sheet.append([first.get(column) for column in columns])
+        for row in rows:
+            sheet.append([row.get(column) for column in columns])
+        workbook.save(buffer)
+        return 'xlsx'
+
+    # header=False - продолжение уже начатого CSV: без BOM и строки заголовка
+    text = io.TextIOWrapper(buffer, encoding='utf-8-sig' if header else 'utf-8', newline='')
+    writer = csv.writer(text)
+    if header:
+        writer.writerow(columns)
+    if first:
+        writer.writerow([first.get(column) for column in columns])
+    for row in rows:
+        writer.writerow([row.get(column) for column in columns])
+    text.flush()
+    text.detach()
+    return 'csv'
+
+
+async def send_report(chat_ids, path, filename, caption):
+    # Файл загружается в Telegram один раз - первому получателю, который его
+    # принял; остальным file_id уходит параллельно, медленный админ не
+    # задерживает других
+    file_id = None
+    pending = list(chat_ids)
+    while pending and file_id is None:
+        chat_id = pending.pop(0)
+        try:
+            await outbound.acquire_async('report')
+            # aiohttp закрывает файл после загрузки, поэтому для каждой попытки открываем заново
+            with open(path, 'rb') as file:
+                sent = await async_bot.send_document(chat_id, file, caption=caption, visible_file_name=filename)
+            file_id = sent.document.file_id
+        except Exception as e:
+            print(f"Ошибка при отправке отчёта {chat_id}: {str(e)}")
+
+    async def send_file_id(chat_id):
+        try:
+            await outbound.acquire_async('report')
+            await async_bot.send_document(chat_id, file_id, caption=caption)
+        except Exception as e:
+            print(f"Ошибка при отправке отчёта {chat_id}: {str(e)}")
+
+    if file_id:
+        await asyncio.gather(*(send_file_id(chat_id) for chat_id in pending))
+    return file_id
+
+
+def clear_report_dir() :
+    # Файлы отчётов (имена и телефоны) не должны переживать процесс бота
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    for filename in os.listdir(REPORT_DIR) :
+        try :
+            os.remove(os.path.join(REPORT_DIR, filename))
+        except OSError as e :
+            print(f"Не удалось удалить файл отчёта {filename}: {str(e)}")
+
+
+# Кэш готовых отчётов: ключ - тип отчёта, запись помнит, сколько регистраций
+# в нём учтено, file_id загруженного в Telegram файла и (для CSV) путь к
+# файлу в REPORT_DIR, чтобы при новых регистрациях дописать только новые строки.
+# Файл удаляется, когда запись вытесняется или заменяется; сборка, которая
+# дописывает к нему строки, работает со своей жёсткой ссылкой (см. pin).
+class ReportCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry['created'] > self.ttl:
+                self._discard(self.entries.pop(key))
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, hwm, file_id, path=None):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None and old['path'] != path:
+                self._discard(old)
+            self.entries[key] = {'hwm': hwm, 'file_id': file_id, 'path': path, 'created': time.monotonic()}
+            while len(self.entries) > self.max_entries:
+                self._discard(self.entries.popitem(last=False)[1])
+
+    def pin(self, key, hwm):
+        # Отдельная ссылка на CSV записи с данным hwm: файл остаётся доступен
+        # сборке, даже если запись тем временем заменят. Ссылку удаляет вызывающий
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['hwm'] != hwm or not entry['path']:
+                return None
+            path = f"{entry['path']}-{secrets.token_hex(4)}"
+            try:
+                os.link(entry['path'], path)
+            except OSError:
+                shutil.copyfile(entry['path'], path)
+            return path
+
+    @staticmethod
+    def _discard(entry):
+        if entry['path']:
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                pass
+
+
+report_cache = ReportCache(REPORT_CACHE_SIZE, REPORT_CACHE_TTL)
+
+
+def render_report(rows, name, fmt=REPORT_FORMAT, header=True, prefix_path=None):
+    # Выполняется в процессе пула: отчёт пишется во временный файл, в основной
+    # процесс возвращается только путь. prefix_path - ранее собранный CSV,
+    # который копируется в начало файла
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(prefix='report_', dir=REPORT_DIR, delete=False) as file:
+        try:
+            if prefix_path:
+                with open(prefix_path, 'rb') as prefix:
+                    shutil.copyfileobj(prefix, file)
+            fmt = write_report(rows, file, fmt, header)
+        except BaseException:
+            file.close()
+            os.remove(file.name)
+            raise
+    return file.name, f"{name}.{fmt}"
+
+
+def submit_report(chat_ids, rows, name, caption, cache_key=None, hwm=None, prefix=None):
+    # Отчёт собирается в пуле процессов по снимку строк, чтобы не занимать
+    # потоки обработчиков; готовый файл отправляется из асинхронного контура.
+    # prefix - путь к ранее собранному CSV, к которому дописываются только rows;
+    # файл принадлежит сборке и удаляется после неё (см. ReportCache.pin)
+    async def deliver(future):
+        if prefix is not None:
+            os.remove(prefix)
+        try:
+            path, filename = future.result()
+            cached = False
+            try:
+                file_id = await send_report(chat_ids, path, filename, caption)
+                if cache_key and file_id:
+                    # CSV остаётся на диске для дописывания, остальное удаляем
+                    cached = filename.endswith('.csv')
+                    report_cache.put(cache_key, hwm, file_id, path if cached else None)
+            finally:
+                if not cached:
+                    os.remove(path)
+        except Exception as e:
+            print(f"Ошибка при формировании отчёта {name}: {str(e)}")
+            traceback.print_exc()
+            await notify_failure()
+
+    async def notify_failure():
+        async def notify(chat_id):
+            try:
+                await outbound.acquire_async('report')
+                await async_bot.send_message(chat_id, "⚠️ Не удалось сформировать отчёт. Попробуйте позже.")
+            except Exception:
+                pass
+
+        await asyncio.gather(*(notify(chat_id) for chat_id in chat_ids))
+
+    if prefix is not None:
+        try:
+            future = submit_to_report_pool(render_report, rows, name, 'csv', False, prefix)
+        except Exception:
+            os.remove(prefix)
+            raise
+    else:
+        future = submit_to_report_pool(render_report, rows, name, REPORT_FORMAT)
+    future.add_done_callback(lambda done: runtime.submit(deliver(done)))
+    return future
 
 
 def send_weekly_report() :
@@ -95,69 +1811,82 @@ def send_weekly_report() :
         if not storage.event_registrations :
             return
 
-        df = pd.DataFrame(storage.event_registrations)
+        # Берём только регистрации за последние 7 дней
         week_ago = datetime.now() - timedelta(days=7)
-        df['Дата регистрации'] = pd.to_datetime(df['Дата регистрации'])
-        weekly_data = df[df['Дата регистрации'] >= week_ago]
-
-        if weekly_data.empty :
+        rows, times = storage.event_registrations.window(week_ago)
+        if not rows :
             return
 
-        filename = f"weekly_registrations_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
-        weekly_data.to_excel(filename, index=False)
-
-        for admin_id in list(storage.admins.keys()) :
-            try :
-                with open(filename, 'rb') as file :
-                    bot.send_document(admin_id, file, caption="📊 Еженедельный отчёт по регистрациям")
-            except Exception as e :
-                print(f"Ошибка при отправке отчёта админу {admin_id}: {str(e)}")
-
-        os.remove(filename)
+        weekly_rows = [{**row, 'Дата регистрации' : registered_at} for row, registered_at in zip(rows, times)]
+        submit_report(list(storage.admins.keys()), weekly_rows,
+                      f"weekly_registrations_{datetime.now().strftime('%Y-%m-%d')}",
+                      "📊 Еженедельный отчёт по регистрациям")
     except Exception as e :
         print(f"Ошибка в send_weekly_report: {str(e)}")
         traceback.print_exc()
 
 
-def mailing_scheduler_thread() :
-    while True :
-        try :
-            schedule.run_pending()
-            time.sleep(1)
-        except Exception as e :
-            print(f"Ошибка в планировщике: {str(e)}")
-            time.sleep(5)
+# Статические клавиатуры собираются и сериализуются в JSON один раз при
+# запуске; telebot передаёт готовую строку в запрос без преобразований
+def build_keyboard(*rows) :
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    for row in rows :
+        markup.add(*row)
+    return markup.to_json()
+
+
+WEEKDAYS = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
+
+KEYBOARDS = {
+    'user': build_keyboard(['Регистрация на мероприятие', 'Прислать CV для вакансии']),
+    'admin': build_keyboard(['📊 Получить список регистраций']),
+    'main_admin': build_keyboard(
+        ['📊 Получить список регистраций'],
+        ['📧 Управление рассылкой'],
+        ['👥 Управление администраторами'],
+        ['⏰ Управление напоминаниями'],
+        ['📢 Статус парсинга'],
+    ),
+    'review': build_keyboard(['✅ Отправить', '✏️ Редактировать']),
+    'edit_event': build_keyboard(
+        ['✏️ Изменить ФИО'], ['📱 Изменить телефон'], ['🎯 Изменить мероприятие'],
+        ['🪪 Изменить пропуск'], ['👤 Изменить username'], ['⬅️ Назад к просмотру'],
+    ),
+    'edit_vacancy': build_keyboard(
+        ['✏️ Изменить ФИО'], ['📱 Изменить телефон'], ['💼 Изменить вакансию'],
+        ['📝 Изменить информацию о себе'], ['📎 Изменить CV'], ['👤 Изменить username'],
+        ['⬅️ Назад к просмотру'],
+    ),
+    'yes_no': build_keyboard(['Да', 'Нет']),
+    'reminder_settings': build_keyboard(
+        ['📝 Установить текст напоминания', '🔄 Изменить частоту'],
+        ['👁 Просмотреть текущие настройки', '⬅️ Назад'],
+    ),
+    'reminder_frequency': build_keyboard(['1 неделя', '2 недели', '3 недели'], ['❌ Отмена']),
+    'mailing_settings': build_keyboard(
+        ['🔘 Включить/выключить рассылку', '📅 Изменить день рассылки'],
+        ['⏰ Изменить время рассылки', '⬅️ Назад'],
+    ),
+    'mailing_day': build_keyboard(*[[day] for day in WEEKDAYS], ['❌ Отмена']),
+    'admins_management': build_keyboard(
+        ['➕ Добавить администратора', '➖ Удалить администратора'],
+        ['📋 Список администраторов', '⬅️ Назад'],
+    ),
+    'remove': types.ReplyKeyboardRemove().to_json(),
+}
 
 
 def user_menu(chat_id) :
     try :
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        btn1 = types.KeyboardButton('Регистрация на мероприятие')
-        btn2 = types.KeyboardButton('Прислать CV для вакансии')
-        markup.add(btn1, btn2)
-        bot.send_message(chat_id, "👋 Привет! Это бот  мы активно делимся уникальными вакансиями, мероприятиями, а также организуем кейс-чемпионаты.\nЧто вас интересует?", reply_markup=markup)
+        bot.send_message(chat_id, "👋 Привет! Это бот  мы активно делимся уникальными вакансиями, мероприятиями, а также организуем кейс-чемпионаты.\nЧто вас интересует?", reply_markup=KEYBOARDS['user'])
     except Exception as e :
         handle_error(chat_id, e)
 
 
 def admin_menu(message) :
     try :
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-
-        if is_main_admin(message.chat.id) :
-            buttons = [
-                '📊 Получить список регистраций',
-                '📧 Управление рассылкой',
-                '👥 Управление администраторами',
-                '⏰ Управление напоминаниями','📢 Статус парсинга'
-            ]
-        else :
-            buttons = ['📊 Получить список регистраций']
-
-        for button in buttons :
-            markup.add(types.KeyboardButton(button))
-
-        bot.send_message(message.chat.id, "🛠 Панель администратора:", reply_markup=markup)
+        keyboard = KEYBOARDS['main_admin'] if is_main_admin(message.chat.id) else KEYBOARDS['admin']
+        bot.send_message(message.chat.id, "🛠 Панель администратора:", reply_markup=keyboard)
     except Exception as e :
         handle_error(message.chat.id, e)
 
@@ -175,10 +1904,12 @@ def handle_error(chat_id, error) :
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     try:
+        # /start сбрасывает незаконченную анкету
+        storage.end_session(message.chat.id)
         if is_admin(message.chat.id):
             admin_menu(message)
         else:
-            storage.subscribed_users.add(message.chat.id)
+            storage.subscribe(message.chat.id)
             user_menu(message.chat.id)
             # Отправляем приветственное сообщение с информацией о напоминаниях
             bot.send_message(
@@ -194,7 +1925,7 @@ def send_welcome(message):
 def unsubscribe(message):
     try:
         if message.chat.id in storage.subscribed_users:
-            storage.subscribed_users.remove(message.chat.id)
+            storage.unsubscribe(message.chat.id)
             bot.send_message(message.chat.id, "🔕 Вы отписались от рассылки мероприятий и напоминаний.")
         else:
             bot.send_message(message.chat.id, "ℹ️ Вы не подписаны на рассылку.")
@@ -223,17 +1954,16 @@ def add_channel_by_id(message) :
         channel_id = int(channel_id)
 
         try :
-            chat = bot.get_chat(channel_id)
+            chat = tg_cache.get_chat(channel_id)
             if chat.type != 'channel' :
                 bot.reply_to(message, "❌ Указанный ID не является каналом")
                 return
 
-            chat_member = bot.get_chat_member(channel_id, bot.get_me().id)
-            if chat_member.status not in ['administrator', 'creator'] :
+            if not bot_is_admin(channel_id) :
                 bot.reply_to(message, "❌ Бот не является администратором этого канала")
                 return
 
-            storage.channels_to_monitor.add(channel_id)
+            storage.add_channel(channel_id)
             bot.reply_to(message, f"✅ Канал {chat.title} (ID: {channel_id}) добавлен для мониторинга")
         except Exception as e :
             bot.reply_to(message, f"❌ Ошибка: {str(e)}")
@@ -252,12 +1982,11 @@ def add_channel(message) :
             channel_id = message.forward_from_chat.id
 
             try :
-                chat_member = bot.get_chat_member(channel_id, bot.get_me().id)
-                if chat_member.status not in ['administrator', 'creator'] :
+                if not bot_is_admin(channel_id) :
                     bot.reply_to(message, "❌ Бот не является администратором этого канала")
                     return
 
-                storage.channels_to_monitor.add(channel_id)
+                storage.add_channel(channel_id)
                 bot.reply_to(message,
                              f"✅ Канал {message.forward_from_chat.title} (ID: {channel_id}) добавлен для мониторинга")
             except Exception as e :
@@ -282,7 +2011,7 @@ def remove_channel(message) :
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
         for channel_id in storage.channels_to_monitor :
             try :
-                chat = bot.get_chat(channel_id)
+                chat = tg_cache.get_chat(channel_id)
                 markup.add(f"{chat.title} (ID: {channel_id})")
             except :
                 markup.add(f"ID: {channel_id}")
@@ -297,7 +2026,7 @@ def remove_channel(message) :
 def process_remove_channel(message) :
     try :
         if message.text == '❌ Отмена' :
-            bot.send_message(message.chat.id, "❌ Отмена", reply_markup=types.ReplyKeyboardRemove())
+            bot.send_message(message.chat.id, "❌ Отмена", reply_markup=KEYBOARDS['remove'])
             return
 
         channel_id = None
@@ -309,28 +2038,60 @@ def process_remove_channel(message) :
             channel_id = int(message.text[4 :])
 
         if channel_id is None or channel_id not in storage.channels_to_monitor :
-            bot.send_message(message.chat.id, "❌ Неверный выбор канала", reply_markup=types.ReplyKeyboardRemove())
+            bot.send_message(message.chat.id, "❌ Неверный выбор канала", reply_markup=KEYBOARDS['remove'])
             return
 
-        storage.channels_to_monitor.remove(channel_id)
-        bot.send_message(message.chat.id, f"✅ Канал удален из мониторинга", reply_markup=types.ReplyKeyboardRemove())
+        storage.remove_channel(channel_id)
+        bot.send_message(message.chat.id, f"✅ Канал удален из мониторинга", reply_markup=KEYBOARDS['remove'])
     except Exception as e :
         handle_error(message.chat.id, e)
 
 
-@bot.message_handler(func=lambda m : m.text == '📢 Статус парсинга' and is_main_admin(m.chat.id))
+def has_active_form(message) :
+    if message.chat.type != 'private' :
+        return False
+    user = storage.get_session(message.chat.id)
+    return user is not None and user.step in FORM_STEPS
+
+
+# Сообщения чата с незаконченной анкетой идут в обработчик её текущего шага.
+# Команды зарегистрированы выше и обрабатываются как обычно.
+@bot.message_handler(content_types=['text', 'photo', 'document', 'video', 'audio', 'voice', 'sticker'],
+                     func=has_active_form)
+def dispatch_form_step(message) :
+    step = storage.user_data[message.chat.id].step
+    FORM_STEPS[step](message)
+
+
+# Кнопки меню (маршруты объявлены через text_router.route у обработчиков)
+def match_menu_button(message) :
+    # Найденный обработчик запоминается в сообщении, чтобы не искать его повторно
+    message.menu_handler = text_router.lookup(message)
+    return message.menu_handler is not None
+
+
+@bot.message_handler(func=match_menu_button)
+def dispatch_menu_button(message) :
+    message.menu_handler(message)
+
+
+@text_router.route(['📢 Статус парсинга'], 'main')
 def chat_monitoring_status(message) :
     try :
         status = "🟢 Активен"
         text = f"📢 Статус парсинга:\n\n{status}\n\n"
         text += f"Подписчиков на рассылку: {len(storage.subscribed_users)}\n"
-        text += f"Отслеживаемых каналов: {len(storage.channels_to_monitor)}\n\n"
+        text += f"Отслеживаемых каналов: {len(storage.channels_to_monitor)}\n"
+        text += f"Незаконченных анкет: {storage.active_sessions()}\n"
+        text += f"Повторных объявлений пропущено: {announcements.duplicates} (сэкономлено отправок: {announcements.saved_sends})\n"
+        depths = outbound.depths()
+        text += "Очередь исходящих: " + ", ".join(f"{name} {depth}" for name, depth in depths.items()) + "\n\n"
 
         if storage.channels_to_monitor :
             text += "Список отслеживаемых каналов:\n"
             for channel_id in storage.channels_to_monitor :
                 try :
-                    chat = bot.get_chat(channel_id)
+                    chat = tg_cache.get_chat(channel_id)
                     text += f"- {chat.title} (ID: {channel_id})\n"
                 except Exception as e :
                     text += f"- ID: {channel_id} (не удалось получить информацию)\n"
@@ -341,43 +2102,35 @@ def chat_monitoring_status(message) :
     except Exception as e :
         handle_error(message.chat.id, e)
 
-@bot.message_handler(func=lambda m: m.text == '⏰ Управление напоминаниями' and is_main_admin(m.chat.id))
+@text_router.route(['⏰ Управление напоминаниями'], 'main')
 def reminder_settings_menu(message):
     try:
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add('📝 Установить текст напоминания', '🔄 Изменить частоту')
-        markup.add('👁 Просмотреть текущие настройки', '⬅️ Назад')
-
         bot.send_message(
             message.chat.id,
             "⏰ Меню управления напоминаниями:",
-            reply_markup=markup
+            reply_markup=KEYBOARDS['reminder_settings']
         )
     except Exception as e:
         handle_error(message.chat.id, e)
 
 
-@bot.message_handler(func=lambda m : m.text in ['📝 Установить текст напоминания', '🔄 Изменить частоту',
-                                                '👁 Просмотреть текущие настройки', '⬅️ Назад']
-                                     and is_main_admin(m.chat.id))
+@text_router.route(['📝 Установить текст напоминания', '🔄 Изменить частоту',
+                    '👁 Просмотреть текущие настройки', '⬅️ Назад'], 'main')
 def handle_reminder_settings(message) :
     try :
         if message.text == '📝 Установить текст напоминания' :
             msg = bot.send_message(
                 message.chat.id,
                 "✏️ Введите текст напоминания:",
-                reply_markup=types.ReplyKeyboardRemove()
+                reply_markup=KEYBOARDS['remove']
             )
             bot.register_next_step_handler(msg, process_reminder_text)
 
         elif message.text == '🔄 Изменить частоту' :
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-            markup.add('1 неделя', '2 недели', '3 недели')
-            markup.add('❌ Отмена')
             msg = bot.send_message(
                 message.chat.id,
                 "Выберите частоту отправки напоминаний:",
-                reply_markup=markup
+                reply_markup=KEYBOARDS['reminder_frequency']
             )
             bot.register_next_step_handler(msg, process_reminder_frequency)
 
@@ -404,11 +2157,12 @@ def handle_reminder_settings(message) :
 
 def process_reminder_text(message) :
     try :
-        storage.reminder_text = message.text
+        storage.set_setting('reminder_text', message.text)
+        schedule_reminders(keep_existing=True)
         bot.send_message(
             message.chat.id,
             "✅ Текст напоминания сохранен",
-            reply_markup=types.ReplyKeyboardRemove()
+            reply_markup=KEYBOARDS['remove']
         )
         reminder_settings_menu(message)
     except Exception as e :
@@ -422,20 +2176,21 @@ def process_reminder_frequency(message) :
             return
 
         if message.text == '1 неделя' :
-            storage.reminder_frequency = 1
+            storage.set_setting('reminder_frequency', 1)
         elif message.text == '2 недели' :
-            storage.reminder_frequency = 2
+            storage.set_setting('reminder_frequency', 2)
         elif message.text == '3 недели' :
-            storage.reminder_frequency = 3
+            storage.set_setting('reminder_frequency', 3)
         else :
             bot.send_message(message.chat.id, "❌ Неверный выбор")
             reminder_settings_menu(message)
             return
+        schedule_reminders()
 
         bot.send_message(
             message.chat.id,
             f"✅ Частота напоминаний установлена: {message.text}",
-            reply_markup=types.ReplyKeyboardRemove()
+            reply_markup=KEYBOARDS['remove']
         )
         reminder_settings_menu(message)
     except Exception as e :
@@ -443,53 +2198,41 @@ def process_reminder_frequency(message) :
 
 def send_reminders():
     try:
-        if not storage.reminder_text or not storage.subscribed_users:
+        if not storage.reminder_text:
             return
 
-        # Проверяем, нужно ли отправлять напоминание
-        if storage.last_reminder_sent:
-            delta = datetime.now() - storage.last_reminder_sent
-            days_needed = storage.reminder_frequency * 7
-            if delta.days < days_needed:
-                return
-
-        # Отправляем напоминания
-        for user_id in storage.subscribed_users:
-            try:
-                bot.send_message(
-                    user_id,
-                    f"⏰ Напоминание:\n\n{storage.reminder_text}"
-                )
-            except Exception as e:
-                print(f"Ошибка при отправке напоминания пользователю {user_id}: {str(e)}")
-                storage.subscribed_users.discard(user_id)
+        # Отправляем напоминания через движок рассылок: по снимку списка
+        # подписчиков, пачками, растянуто на REMINDER_WINDOW
+        broadcaster.submit("напоминание", list(storage.subscribed_users), 'send_message',
+                           f"⏰ Напоминание:\n\n{storage.reminder_text}",
+                           spread=(REMINDER_WINDOW, REMINDER_BATCH_SIZE))
 
-        storage.last_reminder_sent = datetime.now()
-        print(f"Напоминания отправлены {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+        storage.set_setting('last_reminder_sent', datetime.now())
+        print(f"Напоминания поставлены в очередь {datetime.now().strftime('%Y-%m-%d %H:%M')}")
     except Exception as e:
         print(f"Ошибка в send_reminders: {str(e)}")
         traceback.print_exc()
+    finally:
+        # Следующее напоминание - через reminder_frequency недель
+        schedule_reminders()
 
-def mailing_scheduler_thread():
-    while True:
-        try:
-            schedule.run_pending()
-            send_reminders()  # Добавляем вызов функции отправки напоминаний
-            time.sleep(1)
-        except Exception as e:
-            print(f"Ошибка в планировщике: {str(e)}")
-            time.sleep(5)
+
+# Задачи, которые можно поставить на таймер
+TIMER_TASKS = {
+    'weekly_report': run_weekly_report,
+    'reminder': send_reminders,
+    'post': send_scheduled_post,
+    'session_sweep': sweep_sessions,
+}
 
 def show_review_menu(chat_id, message_text) :
     try :
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add('✅ Отправить', '✏️ Редактировать')
-        msg = bot.send_message(
+        storage.set_step(chat_id, 'review')
+        bot.send_message(
             chat_id,
             message_text,
-            reply_markup=markup
+            reply_markup=KEYBOARDS['review']
         )
-        bot.register_next_step_handler(msg, process_review_step)
     except Exception as e :
         handle_error(chat_id, e)
 
@@ -521,32 +2264,13 @@ def process_review_step(message) :
 def show_edit_menu(chat_id):
     try:
         user = storage.user_data[chat_id]
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-
-        if user.option == 'event':
-            buttons = [
-                '✏️ Изменить ФИО', '📱 Изменить телефон',
-                '🎯 Изменить мероприятие', '🪪 Изменить пропуск',
-                '👤 Изменить username'
-            ]
-        else:
-            buttons = [
-                '✏️ Изменить ФИО', '📱 Изменить телефон',
-                '💼 Изменить вакансию', '📝 Изменить информацию о себе',
-                '📎 Изменить CV', '👤 Изменить username'
-            ]
-
-        for button in buttons:
-            markup.add(button)
-
-        markup.add('⬅️ Назад к просмотру')
-
-        msg = bot.send_message(
+        keyboard = KEYBOARDS['edit_event'] if user.option == 'event' else KEYBOARDS['edit_vacancy']
+        storage.set_step(chat_id, 'edit_menu')
+        bot.send_message(
             chat_id,
             "🔧 Что вы хотите изменить?",
-            reply_markup=markup
+            reply_markup=keyboard
         )
-        bot.register_next_step_handler(msg, handle_edit_selection)
     except Exception as e:
         handle_error(chat_id, e)
 
@@ -561,42 +2285,32 @@ def handle_edit_selection(message):
             return
 
         if 'ФИО' in message.text:
-            user.step = 'edit_name'
-            msg = bot.send_message(chat_id, "✏️ Введите новое ФИО:", reply_markup=types.ReplyKeyboardRemove())
-            bot.register_next_step_handler(msg, process_edit_step)
+            storage.set_step(chat_id, 'edit_name')
+            bot.send_message(chat_id, "✏️ Введите новое ФИО:", reply_markup=KEYBOARDS['remove'])
         elif 'телефон' in message.text:
-            user.step = 'edit_phone'
-            msg = bot.send_message(chat_id, "📱 Введите новый телефон:", reply_markup=types.ReplyKeyboardRemove())
-            bot.register_next_step_handler(msg, process_edit_step)
+            storage.set_step(chat_id, 'edit_phone')
+            bot.send_message(chat_id, "📱 Введите новый телефон:", reply_markup=KEYBOARDS['remove'])
         elif 'мероприятие' in message.text:
-            user.step = 'edit_event'
-            msg = bot.send_message(chat_id, "🎯 Введите новое мероприятие:", reply_markup=types.ReplyKeyboardRemove())
-            bot.register_next_step_handler(msg, process_edit_step)
+            storage.set_step(chat_id, 'edit_event')
+            bot.send_message(chat_id, "🎯 Введите новое мероприятие:", reply_markup=KEYBOARDS['remove'])
         elif 'вакансию' in message.text:
-            user.step = 'edit_vacancy'
-            msg = bot.send_message(chat_id, "💼 Введите новую вакансию:", reply_markup=types.ReplyKeyboardRemove())
-            bot.register_next_step_handler(msg, process_edit_step)
+            storage.set_step(chat_id, 'edit_vacancy')
+            bot.send_message(chat_id, "💼 Введите новую вакансию:", reply_markup=KEYBOARDS['remove'])
         elif 'информацию о себе' in message.text:
-            user.step = 'edit_about'
-            msg = bot.send_message(chat_id, "📝 Введите новую информацию о себе:",
-                                   reply_markup=types.ReplyKeyboardRemove())
-            bot.register_next_step_handler(msg, process_edit_step)
+            storage.set_step(chat_id, 'edit_about')
+            bot.send_message(chat_id, "📝 Введите новую информацию о себе:",
+                                   reply_markup=KEYBOARDS['remove'])
         elif 'пропуск' in message.text:
-            user.step = 'edit_pass'
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-            markup.add('Да', 'Нет')
-            msg = bot.send_message(chat_id, "🪪 Нужен ли вам пропуск?", reply_markup=markup)
-            bot.register_next_step_handler(msg, process_edit_step)
+            storage.set_step(chat_id, 'edit_pass')
+            bot.send_message(chat_id, "🪪 Нужен ли вам пропуск?", reply_markup=KEYBOARDS['yes_no'])
         elif 'CV' in message.text:
-            user.step = 'edit_cv'
-            msg = bot.send_message(chat_id, "📎 Прикрепите новое CV (файл PDF или DOCX):",
-                                   reply_markup=types.ReplyKeyboardRemove())
-            bot.register_next_step_handler(msg, process_edit_step)
+            storage.set_step(chat_id, 'edit_cv')
+            bot.send_message(chat_id, "📎 Прикрепите новое CV (файл PDF или DOCX):",
+                                   reply_markup=KEYBOARDS['remove'])
         elif 'username' in message.text:
-            user.step = 'edit_username'
-            msg = bot.send_message(chat_id, "👤 Введите новый username (без @):",
-                                   reply_markup=types.ReplyKeyboardRemove())
-            bot.register_next_step_handler(msg, process_edit_step)
+            storage.set_step(chat_id, 'edit_username')
+            bot.send_message(chat_id, "👤 Введите новый username (без @):",
+                                   reply_markup=KEYBOARDS['remove'])
         else:
             bot.send_message(chat_id, "⚠️ Неверный выбор")
             show_edit_menu(chat_id)
@@ -624,8 +2338,7 @@ def process_edit_step(message):
             if message.document:
                 user.cv_file_id = message.document.file_id
             else:
-                msg = bot.send_message(chat_id, "⚠️ Пожалуйста, прикрепите файл")
-                bot.register_next_step_handler(msg, process_edit_step)
+                bot.send_message(chat_id, "⚠️ Пожалуйста, прикрепите файл")
                 return
         elif user.step == 'edit_username':
             username = message.text.strip()
@@ -639,16 +2352,15 @@ def process_edit_step(message):
         handle_error(chat_id, e)
 
 
-@bot.message_handler(func=lambda m: m.text == 'Регистрация на мероприятие' and not is_admin(m.chat.id))
+@text_router.route(['Регистрация на мероприятие'], 'user')
 def start_event_registration(message):
     try:
         storage.user_data[message.chat.id] = UserData()
         storage.user_data[message.chat.id].option = 'event'
-        storage.user_data[message.chat.id].step = 'name'
         # Сохраняем username, если он есть
         storage.user_data[message.chat.id].username = message.from_user.username
-        msg = bot.reply_to(message, "✏️ Введите ваше ФИО:", reply_markup=types.ReplyKeyboardRemove())
-        bot.register_next_step_handler(msg, process_name_step)
+        storage.set_step(message.chat.id, 'name')
+        bot.reply_to(message, "✏️ Введите ваше ФИО:", reply_markup=KEYBOARDS['remove'])
     except Exception as e:
         handle_error(message.chat.id, e)
 
@@ -658,9 +2370,8 @@ def process_name_step(message) :
     try :
         chat_id = message.chat.id
         storage.user_data[chat_id].name = message.text
-        storage.user_data[chat_id].step = 'phone'
-        msg = bot.reply_to(message, "📱 Введите ваш номер телефона:")
-        bot.register_next_step_handler(msg, process_phone_step)
+        storage.set_step(chat_id, 'phone')
+        bot.reply_to(message, "📱 Введите ваш номер телефона:")
     except Exception as e :
         handle_error(message.chat.id, e)
 
@@ -671,13 +2382,11 @@ def process_phone_step(message) :
         storage.user_data[chat_id].phone = message.text
 
         if storage.user_data[chat_id].option == 'event' :
-            storage.user_data[chat_id].step = 'event'
-            msg = bot.reply_to(message, "🎯 Пожалуйста, введите название мероприятия, на которое хотите зарегистрироваться (можно ориентироваться на название, указанное в посте канала):")
-            bot.register_next_step_handler(msg, process_event_step)
+            storage.set_step(chat_id, 'event')
+            bot.reply_to(message, "🎯 Пожалуйста, введите название мероприятия, на которое хотите зарегистрироваться (можно ориентироваться на название, указанное в посте канала):")
         else :
-            storage.user_data[chat_id].step = 'vacancy'
-            msg = bot.reply_to(message, "💼 Пожалуйста, введите название вакансии, которая вас интересует (можно ориентироваться на название, указанное в посте канала):")
-            bot.register_next_step_handler(msg, process_vacancy_step)
+            storage.set_step(chat_id, 'vacancy')
+            bot.reply_to(message, "💼 Пожалуйста, введите название вакансии, которая вас интересует (можно ориентироваться на название, указанное в посте канала):")
     except Exception as e :
         handle_error(message.chat.id, e)
 
@@ -686,12 +2395,8 @@ def process_event_step(message) :
     try :
         chat_id = message.chat.id
         storage.user_data[chat_id].event_or_vacancy = message.text
-        storage.user_data[chat_id].step = 'pass'
-
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add('Да', 'Нет')
-        msg = bot.reply_to(message, "🪪 Нужен ли вам пропуск в НИУ ВШЭ?\nВыберите нет, если мероприятие онлайн", reply_markup=markup)
-        bot.register_next_step_handler(msg, process_pass_step)
+        storage.set_step(chat_id, 'pass')
+        bot.reply_to(message, "🪪 Нужен ли вам пропуск в НИУ ВШЭ?\nВыберите нет, если мероприятие онлайн", reply_markup=KEYBOARDS['yes_no'])
     except Exception as e :
         handle_error(message.chat.id, e)
 
@@ -705,16 +2410,15 @@ def process_pass_step(message) :
         handle_error(message.chat.id, e)
 
 
-@bot.message_handler(func=lambda m: m.text == 'Прислать CV для вакансии' and not is_admin(m.chat.id))
+@text_router.route(['Прислать CV для вакансии'], 'user')
 def start_vacancy_application(message):
     try:
         storage.user_data[message.chat.id] = UserData()
         storage.user_data[message.chat.id].option = 'vacancy'
-        storage.user_data[message.chat.id].step = 'name'
         # Сохраняем username, если он есть
         storage.user_data[message.chat.id].username = message.from_user.username
-        msg = bot.reply_to(message, "✏️ Введите ваше ФИО:", reply_markup=types.ReplyKeyboardRemove())
-        bot.register_next_step_handler(msg, process_name_step)
+        storage.set_step(message.chat.id, 'name')
+        bot.reply_to(message, "✏️ Введите ваше ФИО:", reply_markup=KEYBOARDS['remove'])
     except Exception as e:
         handle_error(message.chat.id, e)
 
@@ -723,9 +2427,8 @@ def process_vacancy_step(message) :
     try :
         chat_id = message.chat.id
         storage.user_data[chat_id].event_or_vacancy = message.text
-        storage.user_data[chat_id].step = 'about'
-        msg = bot.reply_to(message, "📝 Пожалуйста, напишите несколько предложений, почему вас интересует данная вакансия и почему вы считаете себя подходящим кандидатом:")
-        bot.register_next_step_handler(msg, process_about_step)
+        storage.set_step(chat_id, 'about')
+        bot.reply_to(message, "📝 Пожалуйста, напишите несколько предложений, почему вас интересует данная вакансия и почему вы считаете себя подходящим кандидатом:")
     except Exception as e :
         handle_error(message.chat.id, e)
 
@@ -734,9 +2437,8 @@ def process_about_step(message) :
     try :
         chat_id = message.chat.id
         storage.user_data[chat_id].about = message.text
-        storage.user_data[chat_id].step = 'cv'
-        msg = bot.reply_to(message, "📎 Прикрепите ваше CV (файл PDF или DOCX):")
-        bot.register_next_step_handler(msg, process_cv_step)
+        storage.set_step(chat_id, 'cv')
+        bot.reply_to(message, "📎 Прикрепите ваше CV (файл PDF или DOCX):")
     except Exception as e :
         handle_error(message.chat.id, e)
 
@@ -748,15 +2450,37 @@ def process_cv_step(message) :
             storage.user_data[chat_id].cv_file_id = message.document.file_id
             show_review_menu(chat_id, storage.user_data[chat_id].get_summary())
         else :
-            msg = bot.reply_to(message, "⚠️ Пожалуйста, отправьте файл")
-            bot.register_next_step_handler(msg, process_cv_step)
+            bot.reply_to(message, "⚠️ Пожалуйста, отправьте файл")
     except Exception as e :
         handle_error(message.chat.id, e)
 
 
+# Состояния анкеты и их обработчики
+FORM_STEPS = {
+    'name': process_name_step,
+    'phone': process_phone_step,
+    'event': process_event_step,
+    'pass': process_pass_step,
+    'vacancy': process_vacancy_step,
+    'about': process_about_step,
+    'cv': process_cv_step,
+    'review': process_review_step,
+    'edit_menu': handle_edit_selection,
+    'edit_name': process_edit_step,
+    'edit_phone': process_edit_step,
+    'edit_event': process_edit_step,
+    'edit_vacancy': process_edit_step,
+    'edit_about': process_edit_step,
+    'edit_pass': process_edit_step,
+    'edit_cv': process_edit_step,
+    'edit_username': process_edit_step,
+}
+
+
 def complete_event_registration(chat_id):
     try:
         user = storage.user_data[chat_id]
+        registered_at = datetime.now()
 
         registration_data = {
             'ФИО': user.name,
@@ -764,31 +2488,26 @@ def complete_event_registration(chat_id):
             'Телефон': user.phone,
             'Мероприятие': user.event_or_vacancy,
             'Пропуск': 'Да' if user.needs_pass else 'Нет',
-            'Дата регистрации': datetime.now().strftime('%Y-%m-%d %H:%M')
+            'Дата регистрации': registered_at.strftime(RegistrationLog.DATE_FORMAT)
         }
-        storage.event_registrations.append(registration_data)
+        storage.add_registration(registration_data, registered_at)
 
         bot.send_message(
             chat_id,
             f"🎉 Спасибо за регистрацию!\n\n{user.get_summary()}",
-            reply_markup=types.ReplyKeyboardRemove()
+            reply_markup=KEYBOARDS['remove']
         )
 
-        for admin_id in list(storage.admins.keys()):
-            try:
-                bot.send_message(
-                    admin_id,
-                    f"📝 Спасибо, мы зарегистрировали вас на мероприятие! ✅\nЗа всеми обновлениями вы можете следить в канале https://t.me/hsecareercenter:\n"
-                    f"👤 ФИО: {user.name}\n"
-                    f"👤 Username: @{user.username if user.username else 'не указан'}\n"
-                    f"📱 Телефон: {user.phone}\n"
-                    f"🎯 Мероприятие: {user.event_or_vacancy}\n"
-                    f"🪪 Пропуск: {'Да' if user.needs_pass else 'Нет'}"
-                )
-            except Exception as e:
-                print(f"Ошибка при отправке уведомления админу {admin_id}: {str(e)}")
+        runtime.submit(notify_admins(
+            f"📝 Спасибо, мы зарегистрировали вас на мероприятие! ✅\nЗа всеми обновлениями вы можете следить в канале https://t.me/hsecareercenter:\n"
+            f"👤 ФИО: {user.name}\n"
+            f"👤 Username: @{user.username if user.username else 'не указан'}\n"
+            f"📱 Телефон: {user.phone}\n"
+            f"🎯 Мероприятие: {user.event_or_vacancy}\n"
+            f"🪪 Пропуск: {'Да' if user.needs_pass else 'Нет'}"
+        ))
 
-        del storage.user_data[chat_id]
+        storage.end_session(chat_id)
         user_menu(chat_id)
     except Exception as e:
         handle_error(chat_id, e)
@@ -805,31 +2524,25 @@ def complete_vacancy_application(chat_id):
             'О себе': user.about,
             'Дата подачи': datetime.now().strftime('%Y-%m-%d %H:%M')
         }
-        storage.vacancy_applications.append(application_data)
+        storage.add_application(application_data)
 
         bot.send_message(
             chat_id,
             f"🎉 Спасибо за ваше резюме!\n\n{user.get_summary()}",
-            reply_markup=types.ReplyKeyboardRemove()
+            reply_markup=KEYBOARDS['remove']
         )
 
-        for admin_id in list(storage.admins.keys()):
-            try:
-                bot.send_message(
-                    admin_id,
-                    f"📄 Спасибо! Мы приняли вашу заявку на вакансию! В случае, если ваша кандидатура заинтересует работодателя, мы обязательно с вами свяжемся ✅:\n"
-                    f"👤 ФИО: {user.name}\n"
-                    f"👤 Username: @{user.username if user.username else 'не указан'}\n"
-                    f"📱 Телефон: {user.phone}\n"
-                    f"💼 Вакансия: {user.event_or_vacancy}\n"
-                    f"📝 О себе: {user.about}"
-                )
-                if user.cv_file_id:
-                    bot.send_document(admin_id, user.cv_file_id)
-            except Exception as e:
-                print(f"Ошибка при отправке уведомления админу {admin_id}: {str(e)}")
-
-        del storage.user_data[chat_id]
+        runtime.submit(notify_admins(
+            f"📄 Спасибо! Мы приняли вашу заявку на вакансию! В случае, если ваша кандидатура заинтересует работодателя, мы обязательно с вами свяжемся ✅:\n"
+            f"👤 ФИО: {user.name}\n"
+            f"👤 Username: @{user.username if user.username else 'не указан'}\n"
+            f"📱 Телефон: {user.phone}\n"
+            f"💼 Вакансия: {user.event_or_vacancy}\n"
+            f"📝 О себе: {user.about}",
+            user.cv_file_id
+        ))
+
+        storage.end_session(chat_id)
         user_menu(chat_id)
     except Exception as e:
         handle_error(chat_id, e)
@@ -847,94 +2560,90 @@ def complete_vacancy_application(chat_id) :
             'О себе' : user.about,
             'Дата подачи' : datetime.now().strftime('%Y-%m-%d %H:%M')
         }
-        storage.vacancy_applications.append(application_data)
+        storage.add_application(application_data)
 
         bot.send_message(
             chat_id,
             f"🎉 Спасибо за ваше резюме!\n\n{user.get_summary()}",
-            reply_markup=types.ReplyKeyboardRemove()
+            reply_markup=KEYBOARDS['remove']
         )
 
-        for admin_id in list(storage.admins.keys()) :
-            try :
-                bot.send_message(
-                    admin_id,
-                    f"📄 Новая заявка на вакансию:\n"
-                    f"👤 ФИО: {user.name}\n"
-                    f"📱 Телефон: {user.phone}\n"
-                    f"👤 Username: @{user.username if user.username else 'не указан'}\n"
-                    f"💼 Вакансия: {user.event_or_vacancy}\n"
-                    f"📝 О себе: {user.about}"
-                )
-                if user.cv_file_id :
-                    bot.send_document(admin_id, user.cv_file_id)
-            except Exception as e :
-                print(f"Ошибка при отправке уведомления админу {admin_id}: {str(e)}")
-
-        del storage.user_data[chat_id]
+        runtime.submit(notify_admins(
+            f"📄 Новая заявка на вакансию:\n"
+            f"👤 ФИО: {user.name}\n"
+            f"📱 Телефон: {user.phone}\n"
+            f"👤 Username: @{user.username if user.username else 'не указан'}\n"
+            f"💼 Вакансия: {user.event_or_vacancy}\n"
+            f"📝 О себе: {user.about}",
+            user.cv_file_id
+        ))
+
+        storage.end_session(chat_id)
         user_menu(chat_id)
     except Exception as e :
         handle_error(chat_id, e)
 
 
-@bot.message_handler(func=lambda m : m.text == '📊 Получить список регистраций' and is_admin(m.chat.id))
+@text_router.route(['📊 Получить список регистраций'], 'admin', 'main')
 def send_excel_report(message) :
     try :
         if not storage.event_registrations :
             bot.send_message(message.chat.id, "ℹ️ Нет данных о регистрациях")
             return
 
-        filename = f"registrations_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
-        pd.DataFrame(storage.event_registrations).to_excel(filename, index=False)
-
-        with open(filename, 'rb') as file :
-            bot.send_document(message.chat.id, file, caption="📊 Список регистраций")
+        # Если новых регистраций не было, повторно отправляем уже загруженный файл
+        hwm = len(storage.event_registrations)
+        cached = report_cache.get('registrations')
+        if cached and cached['hwm'] == hwm :
+            bot.send_document(message.chat.id, cached['file_id'], caption="📊 Список регистраций")
+            return
 
-        os.remove(filename)
+        bot.send_message(message.chat.id, "⏳ Отчёт готовится, файл придёт в этот чат, как только будет готов")
+        name = f"registrations_{datetime.now().strftime('%Y%m%d_%H%M')}"
+        prefix = None
+        if cached and cached['path'] is not None and cached['hwm'] < hwm :
+            prefix = report_cache.pin('registrations', cached['hwm'])
+        if prefix is not None :
+            # CSV собирается заново только для новых строк
+            submit_report([message.chat.id], storage.event_registrations.rows[cached['hwm']:hwm], name,
+                          "📊 Список регистраций", cache_key='registrations', hwm=hwm, prefix=prefix)
+        else :
+            submit_report([message.chat.id], storage.event_registrations.rows[:hwm], name,
+                          "📊 Список регистраций", cache_key='registrations', hwm=hwm)
     except Exception as e :
         handle_error(message.chat.id, e)
 
 
-@bot.message_handler(func=lambda m : m.text == '📧 Управление рассылкой' and is_main_admin(m.chat.id))
+@text_router.route(['📧 Управление рассылкой'], 'main')
 def mailing_settings_menu(message) :
     try :
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add('🔘 Включить/выключить рассылку', '📅 Изменить день рассылки')
-        markup.add('⏰ Изменить время рассылки', '⬅️ Назад')
-
         status = "включена" if storage.mailing_settings['enabled'] else "выключена"
-        days = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-        day = days[storage.mailing_settings['day_of_week']]
+        day = WEEKDAYS[storage.mailing_settings['day_of_week']]
 
         text = f"📧 Текущие настройки рассылки:\n\n🔘 Статус: {status}\n📅 День: {day}\n⏰ Время: {storage.mailing_settings['time']}"
-        bot.send_message(message.chat.id, text, reply_markup=markup)
+        bot.send_message(message.chat.id, text, reply_markup=KEYBOARDS['mailing_settings'])
     except Exception as e :
         handle_error(message.chat.id, e)
 
 
-@bot.message_handler(func=lambda m : m.text in ['🔘 Включить/выключить рассылку', '📅 Изменить день рассылки',
-                                                '⏰ Изменить время рассылки', '⬅️ Назад'] and is_main_admin(m.chat.id))
+@text_router.route(['🔘 Включить/выключить рассылку', '📅 Изменить день рассылки',
+                    '⏰ Изменить время рассылки', '⬅️ Назад'], 'main')
 def handle_mailing_settings(message) :
     try :
         if message.text == '🔘 Включить/выключить рассылку' :
-            storage.mailing_settings['enabled'] = not storage.mailing_settings['enabled']
+            storage.update_mailing_settings(enabled=not storage.mailing_settings['enabled'])
             schedule_mailing()
             status = "включена" if storage.mailing_settings['enabled'] else "выключена"
             bot.send_message(message.chat.id, f"✅ Рассылка теперь {status}")
             mailing_settings_menu(message)
 
         elif message.text == '📅 Изменить день рассылки' :
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-            days = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-            for day in days :
-                markup.add(day)
-            markup.add('❌ Отмена')
-            msg = bot.send_message(message.chat.id, "Выберите новый день для рассылки:", reply_markup=markup)
+            msg = bot.send_message(message.chat.id, "Выберите новый день для рассылки:", reply_markup=KEYBOARDS['mailing_day'])
             bot.register_next_step_handler(msg, process_day_change)
 
         elif message.text == '⏰ Изменить время рассылки' :
             msg = bot.send_message(message.chat.id, "Введите новое время в формате ЧЧ:ММ (например, 14:30):",
-                                   reply_markup=types.ReplyKeyboardRemove())
+                                   reply_markup=KEYBOARDS['remove'])
             bot.register_next_step_handler(msg, process_time_change)
 
         elif message.text == '⬅️ Назад' :
@@ -949,9 +2658,8 @@ def process_day_change(message) :
             mailing_settings_menu(message)
             return
 
-        days = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
-        if message.text in days :
-            storage.mailing_settings['day_of_week'] = days.index(message.text)
+        if message.text in WEEKDAYS :
+            storage.update_mailing_settings(day_of_week=WEEKDAYS.index(message.text))
             schedule_mailing()
             bot.send_message(message.chat.id, f"✅ День рассылки изменён на {message.text}")
         else :
@@ -966,7 +2674,7 @@ def process_time_change(message) :
     try :
         time_str = message.text
         datetime.strptime(time_str, '%H:%M')
-        storage.mailing_settings['time'] = time_str
+        storage.update_mailing_settings(time=time_str)
         schedule_mailing()
         bot.send_message(message.chat.id, f"✅ Время рассылки изменено на {time_str}")
         mailing_settings_menu(message)
@@ -977,24 +2685,21 @@ def process_time_change(message) :
         handle_error(message.chat.id, e)
 
 
-@bot.message_handler(func=lambda m : m.text == '👥 Управление администраторами' and is_main_admin(m.chat.id))
+@text_router.route(['👥 Управление администраторами'], 'main')
 def admins_management_menu(message) :
     try :
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add('➕ Добавить администратора', '➖ Удалить администратора')
-        markup.add('📋 Список администраторов', '⬅️ Назад')
-        bot.send_message(message.chat.id, "👥 Управление администраторами:", reply_markup=markup)
+        bot.send_message(message.chat.id, "👥 Управление администраторами:", reply_markup=KEYBOARDS['admins_management'])
     except Exception as e :
         handle_error(message.chat.id, e)
 
 
-@bot.message_handler(func=lambda m : m.text in ['➕ Добавить администратора', '➖ Удалить администратора',
-                                                '📋 Список администраторов', '⬅️ Назад'] and is_main_admin(m.chat.id))
+@text_router.route(['➕ Добавить администратора', '➖ Удалить администратора',
+                    '📋 Список администраторов', '⬅️ Назад'], 'main')
 def handle_admin_management(message) :
     try :
         if message.text == '➕ Добавить администратора' :
             msg = bot.send_message(message.chat.id, "Введите ID нового администратора(можно посмотреть тут https://t.me/username_to_id_bot):",
-                                   reply_markup=types.ReplyKeyboardRemove())
+                                   reply_markup=KEYBOARDS['remove'])
             bot.register_next_step_handler(msg, process_add_admin)
 
         elif message.text == '➖ Удалить администратора' :
@@ -1032,7 +2737,7 @@ def process_add_admin(message) :
         if new_admin_id in storage.admins :
             bot.send_message(message.chat.id, "⚠️ Этот пользователь уже администратор")
         else :
-            storage.admins[new_admin_id] = 'regular'
+            storage.add_admin(new_admin_id, 'regular')
             bot.send_message(message.chat.id, f"✅ Пользователь {new_admin_id} добавлен как администратор")
 
         admins_management_menu(message)
@@ -1047,7 +2752,7 @@ def process_remove_admin(message) :
             return
 
         if message.text in storage.admins and message.text != MAIN_ADMIN_IDS :
-            del storage.admins[message.text]
+            storage.remove_admin(message.text)
             bot.send_message(message.chat.id, f"✅ Администратор {message.text} удалён")
         else :
             bot.send_message(message.chat.id, "❌ Неверный выбор администратора")
@@ -1057,6 +2762,132 @@ def process_remove_admin(message) :
         handle_error(message.chat.id, e)
 
 
+def media_file(message) :
+    if message.photo :
+        return message.photo[-1]
+    return message.document or message.video
+
+
+# Одно и то же объявление часто публикуется в нескольких каналах и группах.
+# Отпечаток - нормализованный текст/подпись и file_unique_id вложений;
+# повтор в пределах окна не рассылается.
+def announcement_fingerprint(*messages) :
+    text = ' '.join(' '.join((message.text or message.caption or '') for message in messages).split()).casefold()
+    media = [item for item in map(media_file, messages) if item is not None]
+    if not text and not media :
+        return None
+    digest = hashlib.sha1(text.encode('utf-8'))
+    for item in media :
+        digest.update(b'\0' + item.file_unique_id.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class AnnouncementIndex:
+    def __init__(self, window):
+        self.window = window
+        self.seen = OrderedDict()  # отпечаток -> время рассылки, по возрастанию времени
+        self.lock = threading.Lock()
+        self.duplicates = 0
+        self.saved_sends = 0
+
+    def add(self, fingerprint, recipients):
+        # True, если объявление новое; для повтора учитываем несделанные отправки
+        now = time.monotonic()
+        with self.lock:
+            while self.seen and now - next(iter(self.seen.values())) > self.window:
+                self.seen.popitem(last=False)
+            if fingerprint in self.seen:
+                self.duplicates += 1
+                self.saved_sends += recipients
+                return False
+            self.seen[fingerprint] = now
+            return True
+
+
+announcements = AnnouncementIndex(ANNOUNCEMENT_DEDUP_WINDOW)
+
+
+# Части альбома приходят отдельными сообщениями с общим media_group_id.
+# Копим их, пока не наступит пауза ALBUM_WAIT, и рассылаем альбом целиком.
+class AlbumBuffer:
+    def __init__(self, wait, flush):
+        self.wait = wait
+        self.flush = flush
+        self.albums = {}
+        self.lock = threading.Lock()
+
+    def add(self, message):
+        with self.lock:
+            album = self.albums.setdefault(message.media_group_id, {'messages': [], 'timer': None})
+            album['messages'].append(message)
+            if album['timer'] is not None:
+                album['timer'].cancel()
+            album['timer'] = threading.Timer(self.wait, self._flush, args=(message.media_group_id,))
+            album['timer'].daemon = True
+            album['timer'].start()
+
+    def _flush(self, media_group_id):
+        with self.lock:
+            album = self.albums.pop(media_group_id, None)
+        if album is None:
+            return
+        try:
+            self.flush(sorted(album['messages'], key=lambda message: message.message_id))
+        except Exception as e:
+            print(f"Ошибка при рассылке альбома {media_group_id}: {str(e)}")
+            traceback.print_exc()
+
+
+# Подписи пересылаемых сообщений по типу источника
+REBROADCAST_LABELS = {
+    'channel': {'title': 'канал', 'place': 'Канал', 'source': 'канала', 'empty': '📢 Новое сообщение из канала'},
+    'group': {'title': 'чат', 'place': 'Чат', 'source': 'чата', 'empty': '📢 Новое сообщение'},
+}
+
+# Кнопка записи под постами каналов
+REGISTER_MARKUP = types.InlineKeyboardMarkup([[
+    types.InlineKeyboardButton('Записаться на мероприятие', callback_data='register_from_chat')
+]]).to_json()
+
+
+def rebroadcast(messages) :
+    # Рассылка поста (или альбома) подписчикам: медиа копируются из исходного
+    # чата через copyMessage, альбом уходит одним sendMediaGroup
+    first = messages[0]
+    kind = 'channel' if first.chat.type == 'channel' else 'group'
+    labels = REBROADCAST_LABELS[kind]
+    markup = REGISTER_MARKUP if kind == 'channel' else None
+    recipients = list(storage.subscribed_users)
+
+    fingerprint = announcement_fingerprint(*messages)
+    if fingerprint and not announcements.add(fingerprint, len(recipients)) :
+        print(f"Сообщение {first.message_id} повторяет уже разосланное объявление")
+        return
+
+    text = next((message.text or message.caption for message in messages if message.text or message.caption), None)
+    text = text or labels['empty']
+    caption = f"{text}\n\n📍 {labels['place']}: {first.chat.title}"
+    title = f"{labels['title']} {first.chat.title}"
+
+    if len(messages) > 1 :
+        media = []
+        for message in messages :
+            media_type = 'photo' if message.photo else 'document' if message.document else 'video'
+            media.append({'type': media_type, 'media': media_file(message).file_id})
+        media[0]['caption'] = caption
+        broadcaster.submit(title, recipients, 'send_media_group', media)
+    elif first.text :
+        broadcaster.submit(title, recipients, 'send_message',
+                           f"📢 Сообщение из {labels['source']} '{first.chat.title}':\n\n{text}", reply_markup=markup)
+    else :
+        broadcaster.submit(title, recipients, 'copy_message', first.chat.id, first.message_id,
+                           caption=caption, reply_markup=markup)
+    print("Сообщение передано в рассылку")
+
+
+album_buffer = AlbumBuffer(ALBUM_WAIT, rebroadcast)
+
+
 @bot.channel_post_handler(content_types=['text', 'photo', 'document', 'video'])
 def handle_channel_post(message) :
     try :
@@ -1068,60 +2899,14 @@ def handle_channel_post(message) :
             return
 
         # Проверяем, что сообщение еще не обрабатывалось
-        if message.message_id in storage.parsed_messages :
+        if not storage.mark_parsed(message.chat.id, message.message_id) :
             print(f"Сообщение {message.message_id} уже обработано")
             return
 
-        storage.parsed_messages.add(message.message_id)
-
-        # Формируем текст сообщения
-        text = message.text if message.text else message.caption if message.caption else "📢 Новое сообщение из канала"
-
-        # Создаем кнопку для регистрации
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton('Записаться на мероприятие', callback_data='register_from_chat'))
-
-        # Рассылаем подписчикам
-        for user_id in storage.subscribed_users :
-            try :
-                if message.photo :
-                    bot.send_photo(
-                        user_id,
-                        message.photo[-1].file_id,
-                        caption=f"{text}\n\n📍 Канал: {message.chat.title}",
-                        reply_markup=markup
-                    )
-                elif message.document :
-                    bot.send_document(
-                        user_id,
-                        message.document.file_id,
-                        caption=f"{text}\n\n📍 Канал: {message.chat.title}",
-                        reply_markup=markup
-                    )
-                elif message.video :
-                    bot.send_video(
-                        user_id,
-                        message.video.file_id,
-                        caption=f"{text}\n\n📍 Канал: {message.chat.title}",
-                        reply_markup=markup
-                    )
-                else :
-                    bot.send_message(
-                        user_id,
-                        f"📢 Сообщение из канала '{message.chat.title}':\n\n{text}",
-                        reply_markup=markup
-                    )
-                print(f"Сообщение отправлено пользователю {user_id}")
-            except Exception as e :
-                print(f"Ошибка при отправке сообщения пользователю {user_id}: {str(e)}")
-                storage.subscribed_users.discard(user_id)
-
-        # Очищаем старые ID сообщений
-        if len(storage.parsed_messages) > 1000 :
-            oldest = sorted(storage.parsed_messages)[:100]
-            storage.parsed_messages = set(sorted(storage.parsed_messages)[100 :])
-
-        print("Сообщение успешно обработано")
+        if message.media_group_id :
+            album_buffer.add(message)
+        else :
+            rebroadcast([message])
     except Exception as e :
         print(f"Ошибка при обработке сообщения из канала: {str(e)}")
         traceback.print_exc()
@@ -1135,8 +2920,7 @@ def handle_group_messages(message) :
 
         # Проверяем, что бот админ в этом чате
         try :
-            chat_member = bot.get_chat_member(message.chat.id, bot.get_me().id)
-            if chat_member.status not in ['administrator', 'creator'] :
+            if not bot_is_admin(message.chat.id) :
                 print(f"Бот не админ в чате {message.chat.id}")
                 return
         except Exception as e :
@@ -1144,59 +2928,27 @@ def handle_group_messages(message) :
             return
 
         # Проверяем, что сообщение еще не обрабатывалось
-        if message.message_id in storage.parsed_messages :
+        if not storage.mark_parsed(message.chat.id, message.message_id) :
             print(f"Сообщение {message.message_id} уже обработано")
             return
 
-        storage.parsed_messages.add(message.message_id)
-
-        # Формируем текст сообщения
-        text = message.text if message.text else message.caption if message.caption else "📢 Новое сообщение"
-
-
-
-        # Рассылаем подписчикам
-        for user_id in storage.subscribed_users :
-            try :
-                if message.photo :
-                    bot.send_photo(
-                        user_id,
-                        message.photo[-1].file_id,
-                        caption=f"{text}\n\n📍 Чат: {message.chat.title}",
-                    )
-                elif message.document :
-                    bot.send_document(
-                        user_id,
-                        message.document.file_id,
-                        caption=f"{text}\n\n📍 Чат: {message.chat.title}",
-                                            )
-                elif message.video :
-                    bot.send_video(
-                        user_id,
-                        message.video.file_id,
-                        caption=f"{text}\n\n📍 Чат: {message.chat.title}",
-                                            )
-                else :
-                    bot.send_message(
-                        user_id,
-                        f"📢 Сообщение из чата '{message.chat.title}':\n\n{text}",
-                                        )
-                print(f"Сообщение отправлено пользователю {user_id}")
-            except Exception as e :
-                print(f"Ошибка при отправке сообщения пользователю {user_id}: {str(e)}")
-                storage.subscribed_users.discard(user_id)
-
-        # Очищаем старые ID сообщений
-        if len(storage.parsed_messages) > 1000 :
-            oldest = sorted(storage.parsed_messages)[:100]
-            storage.parsed_messages = set(sorted(storage.parsed_messages)[100 :])
-
-        print("Сообщение успешно обработано")
+        if message.media_group_id :
+            album_buffer.add(message)
+        else :
+            rebroadcast([message])
     except Exception as e :
         print(f"Ошибка при обработке сообщения из чата: {str(e)}")
         traceback.print_exc()
 
 
+# Бота добавили, удалили или изменили его права в чате
+@bot.my_chat_member_handler()
+def handle_my_chat_member(update) :
+    tg_cache.invalidate(update.chat.id)
+    probed_chats.add(update.chat.id)
+    storage.set_admin_chat(update.chat.id, update.new_chat_member.status in ['administrator', 'creator'])
+
+
 @bot.callback_query_handler(func=lambda call : call.data == 'register_from_chat')
 def handle_register_from_chat(call) :
     try :
@@ -1213,8 +2965,8 @@ def handle_unknown(message) :
             return
 
         if is_admin(message.chat.id) :
-            if message.text in ['📊 Получить список регистраций', '📧 Управление рассылкой',
-                                '👥 Управление администраторами', '📢 Статус парсинга'] :
+            # Кнопка меню, недоступная этому администратору
+            if message.text in text_router.labels :
                 return
             bot.send_message(message.chat.id, "ℹ️ Используйте кнопки меню администратора")
         else :
@@ -1223,21 +2975,181 @@ def handle_unknown(message) :
         handle_error(message.chat.id, e)
 
 
-if __name__ == '__main__' :
-    # Добавим тестовый канал при запуске (можно удалить)
-    TEST_CHANNEL_ID =  # Замените на реальный ID вашего канала
-    storage.channels_to_monitor.add(TEST_CHANNEL_ID)
-    print(f"Добавлен тестовый канал для мониторинга: {TEST_CHANNEL_ID}")
+# Сравнение стоимости выбора обработчика: прежняя цепочка фильтров
+# (перебор лямбд по порядку) против словаря text_router
+def benchmark_router(iterations=200000) :
+    role_checks = {
+        frozenset(['main']): is_main_admin,
+        frozenset(['admin', 'main']): is_admin,
+        frozenset(['user']): lambda chat_id : not is_admin(chat_id),
+    }
+    handlers = {}
+    for (text, role), handler in text_router.routes.items() :
+        texts, roles = handlers.setdefault(handler, (set(), set()))
+        texts.add(text)
+        roles.add(role)
+    chain = [(texts, role_checks[frozenset(roles)], handler) for handler, (texts, roles) in handlers.items()]
+
+    def filter_chain(message) :
+        for texts, check, handler in chain :
+            if message.text in texts and check(message.chat.id) :
+                return handler
+        return None
+
+    senders = [1] + [int(admin_id) for admin_id in list(storage.admins)[:2]]
+    texts = sorted(text_router.labels) + ['привет']
+    messages = [SimpleNamespace(text=text, chat=SimpleNamespace(id=chat_id)) for text in texts for chat_id in senders]
+
+    for name, lookup in (('цепочка фильтров', filter_chain), ('text_router', text_router.lookup)) :
+        started = time.perf_counter()
+        for i in range(iterations) :
+            lookup(messages[i % len(messages)])
+        elapsed = time.perf_counter() - started
+        print(f"{name}: {elapsed / iterations * 1e9:.0f} нс на обновление")
+
+
+# Приём обновлений через webhook: HTTP-обработчик проверяет секрет, кладёт
+# сырое обновление в очередь и сразу отвечает 200, а обновления из очереди
+# передаются в обработчики бота через полосы LaneDispatcher
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode('utf-8'), self.server.secret.encode('utf-8')):
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self.send_response(413 if length > 0 else 400)
+            self.end_headers()
+            return
+        body = self.rfile.read(length)
+        try:
+            self.server.updates.put_nowait(body)
+        except queue.Full:
+            # Telegram повторит доставку позже
+            self.send_response(503)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
 
-    schedule_mailing()
+class WebhookServer:
+    def __init__(self, host, port, queue_size, secret):
+        self.httpd = ThreadingHTTPServer((host, port), WebhookRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.updates = queue.Queue(maxsize=queue_size)
+        # Запросы без этого секрета отклоняются всегда
+        self.httpd.secret = secret
+
+    def _feed(self):
+        # Один поток разбирает очередь, чтобы не нарушить порядок обновлений
+        # одного чата; параллельная обработка - в полосах LaneDispatcher
+        updates = self.httpd.updates
+        while True:
+            body = updates.get()
+            try:
+                update = types.Update.de_json(body.decode('utf-8'))
+                bot.process_new_updates([update])
+            except Exception as e:
+                print(f"Ошибка при обработке обновления из webhook: {str(e)}")
+                traceback.print_exc()
+            finally:
+                updates.task_done()
+
+    def start(self):
+        thread = threading.Thread(target=self._feed, name="webhook-feed")
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self):
+        self.start()
+        host, port = self.httpd.server_address[:2]
+        print(f"Webhook слушает http://{host}:{port}{WEBHOOK_PATH}")
+        self.httpd.serve_forever()
+
+
+def run_webhook() :
+    secret = WEBHOOK_SECRET
+    if not secret :
+        if not WEBHOOK_URL :
+            # Webhook зарегистрирован вне бота - секрет должен быть задан явно
+            raise RuntimeError("Для UPDATE_MODE = 'webhook' без WEBHOOK_URL задайте WEBHOOK_SECRET")
+        secret = secrets.token_urlsafe(32)
+    server = WebhookServer(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_QUEUE_SIZE, secret)
+    if WEBHOOK_URL :
+        bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=secret)
+    server.serve_forever()
 
-    scheduler_thread = threading.Thread(target=mailing_scheduler_thread)
-    scheduler_thread.daemon = True
-    scheduler_thread.start()
+
+if __name__ == '__main__' :
+    # Офлайн-отчёт по последнему снимку журнала: python bot.py --snapshot-report registrations.xlsx
+    if len(sys.argv) > 2 and sys.argv[1] == '--snapshot-report' :
+        snapshot = load_snapshot()
+        if not snapshot :
+            print(f"В каталоге {JOURNAL_DIR} нет снимков")
+            sys.exit(1)
+        with open(sys.argv[2], 'wb') as file :
+            write_report(snapshot['state']['registrations'], file, 'csv' if sys.argv[2].endswith('.csv') else 'xlsx')
+        print(f"Отчёт по снимку от {snapshot['created']} сохранён в {sys.argv[2]}")
+        sys.exit(0)
+
+    # Замер маршрутизации кнопок меню: python bot.py --benchmark-router
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark-router' :
+        benchmark_router()
+        sys.exit(0)
+
+    clear_report_dir()
+    atexit.register(clear_report_dir)
+
+    outbound.start()
+    me = tg_cache.load_me()
+    print(f"Бот @{me.username} (ID: {me.id})")
+
+    # Загружаем сохранённые данные (подписчики, регистрации, каналы, настройки)
+    storage.attach(create_storage_backend())
+    atexit.register(storage.close)
+
+    for channel_id in INITIAL_CHANNEL_IDS :
+        storage.add_channel(channel_id)
+    print(f"Отслеживаемых каналов: {len(storage.channels_to_monitor)}, подписчиков: {len(storage.subscribed_users)}")
+    seed_admin_chats()
+
+    broadcaster.start()
+    broadcaster.resume()
+    atexit.register(runtime.stop)
+    atexit.register(broadcaster.stop)  # atexit вызывает в обратном порядке: до runtime.stop
+    # SIGTERM (остановка при деплое) завершает процесс через atexit, а не мгновенно
+    signal.signal(signal.SIGTERM, lambda signum, frame : sys.exit(0))
+
+    # Восстанавливаем таймеры; пропущенные за время простоя сработают сразу
+    scheduler.restore(storage.timers)
+    schedule_mailing(keep_existing=True)
+    schedule_reminders(keep_existing=True)
+    schedule_session_sweep(keep_existing=True)
+    scheduler.start()
+
+    update_lanes.start()
 
     print("Бот запущен...")
     try :
-        bot.infinity_polling()
+        if UPDATE_MODE == 'webhook' :
+            run_webhook()
+        else :
+            bot.remove_webhook()
+            bot.infinity_polling()
     except Exception as e :
         print(f"Ошибка в основном потоке: {str(e)}")
         traceback.print_exc()
\ No newline at end of file